@@ -1,14 +1,18 @@
 """Support for Roborock cameras."""
-import io
+import asyncio
 import logging
+import zlib
+from concurrent.futures import CancelledError
+from concurrent.futures.process import BrokenProcessPool
 from datetime import timedelta
 from enum import Enum
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Optional, Tuple
 
 from homeassistant.components.camera import Camera, CameraEntityFeature
 from homeassistant.components.vacuum import ATTR_BATTERY_ICON
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.core import Event, HomeAssistant, callback
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.util import slugify
 from roborock import RoborockStateCode
@@ -16,9 +20,17 @@ from roborock.exceptions import RoborockException
 
 from . import EntryData
 from .common.image_handler import ImageHandlerRoborock
-from .common.map_data import MapData
 from .common.map_data_parser import MapDataParserRoborock
-from .common.types import Colors, Drawables, ImageConfig, Sizes, Texts
+from .common.map_render_pool import (
+    EncodedImage,
+    MapRenderPool,
+    ParsedMap,
+    parse_map,
+    reduce_map_image,
+    render_map_image,
+    render_raw_map_image,
+)
+from .common.types import EncoderConfig, ImageConfig
 from .config_flow import CAMERA_VALUES
 from .const import *
 from .coordinator import RoborockDataUpdateCoordinator
@@ -45,6 +57,15 @@ DEFAULT_SIZES = {
 
 NON_REFRESHING_STATES = [RoborockStateCode.charging]
 
+# Parsing, rendering and encoding maps is CPU bound, so it runs in the executor
+# with a bounded number of concurrent jobs shared by all map cameras.
+MAP_PIPELINE_WORKERS = 2
+_MAP_PIPELINE = asyncio.Semaphore(MAP_PIPELINE_WORKERS)
+_MAP_RENDER_POOL = MapRenderPool(MAP_PIPELINE_WORKERS)
+
+# Smaller images are requested at most this many times smaller than the rendered map
+THUMBNAIL_MAX_FACTOR = 16
+
 
 async def async_setup_entry(
         hass: HomeAssistant,
@@ -54,21 +75,27 @@ async def async_setup_entry(
     """Setup Roborock camera."""
     camera_options = config_entry.options.get(CAMERA)
     image_config = None
+    render_process_pool = False
+    data = {}
+    for key, value in CAMERA_VALUES.items():
+        set_nested_dict(data, key, value)
+    # options saved before the encoder settings existed fall back to the defaults
+    encoder_config = dict(data.get(CONF_IMAGE_ENCODER))
     if camera_options:
+        encoder_config.update(camera_options.get(CONF_IMAGE_ENCODER, {}))
+        render_process_pool = camera_options.get(CONF_RENDER_PROCESS_POOL, False)
         image_config = camera_options.get(CONF_MAP_TRANSFORM, {})
         image_config[CONF_INCLUDE_NOGO] = camera_options.get(CONF_INCLUDE_NOGO, True)
         image_config[CONF_INCLUDE_IGNORED_OBSTACLES] = camera_options.get(
             CONF_INCLUDE_IGNORED_OBSTACLES, True
         )
     if not image_config:
-        data = {}
-        for key, value in CAMERA_VALUES.items():
-            set_nested_dict(data, key, value)
         image_config = data.get(CONF_MAP_TRANSFORM)
         image_config[CONF_INCLUDE_NOGO] = data.get(CONF_INCLUDE_NOGO)
         image_config[CONF_INCLUDE_IGNORED_OBSTACLES] = data.get(
             CONF_INCLUDE_IGNORED_OBSTACLES
         )
+        render_process_pool = data.get(CONF_RENDER_PROCESS_POOL)
     domain_data: EntryData = hass.data[DOMAIN][
         config_entry.entry_id
     ]
@@ -78,9 +105,28 @@ async def async_setup_entry(
         coordinator = device_entry_data["coordinator"]
         device_info = coordinator.data
         unique_id = slugify(device_info.device.duid)
-        entities.append(VacuumCameraMap(unique_id, image_config, device_info, coordinator))
+        entities.append(
+            VacuumCameraMap(
+                unique_id,
+                image_config,
+                device_info,
+                coordinator,
+                render_process_pool,
+                encoder_config,
+            )
+        )
     async_add_entities(entities, True)
 
+    @callback
+    def async_shutdown_render_pool(_: Event) -> None:
+        _MAP_RENDER_POOL.shutdown()
+
+    # the pool is shared by all entries, it is started again by the next render that needs it
+    config_entry.async_on_unload(_MAP_RENDER_POOL.reset)
+    config_entry.async_on_unload(
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_shutdown_render_pool)
+    )
+
 
 class VacuumCameraMap(RoborockEntity, Camera):
     """Representation of a Roborock camera map."""
@@ -100,6 +146,7 @@ class VacuumCameraMap(RoborockEntity, Camera):
             ATTRIBUTE_IMAGE,
             ATTRIBUTE_IS_EMPTY,
             ATTRIBUTE_MAP_NAME,
+            ATTRIBUTE_MAP_STATS,
             ATTRIBUTE_MOP_PATH,
             ATTRIBUTE_NO_CARPET_AREAS,
             ATTRIBUTE_NO_GO_AREAS,
@@ -123,6 +170,8 @@ class VacuumCameraMap(RoborockEntity, Camera):
             image_config: dict,
             device_info: RoborockHassDeviceInfo,
             coordinator: RoborockDataUpdateCoordinator,
+            render_process_pool: bool = False,
+            encoder_config: Optional[EncoderConfig] = None,
     ) -> None:
         """Create Roborock map."""
         RoborockEntity.__init__(self, device_info, unique_id, coordinator.api)
@@ -130,16 +179,32 @@ class VacuumCameraMap(RoborockEntity, Camera):
         self.coordinator = coordinator
         self._store_map_image = False
         self._image_config = image_config
+        self._render_process_pool = render_process_pool
         self._sizes = DEFAULT_SIZES
         self._texts = []
         self._drawables = CONF_AVAILABLE_DRAWABLES
         self._colors = ImageHandlerRoborock.COLORS
-        self.content_type = CONTENT_TYPE
+        self._encoder_config = encoder_config or {}
+        self.content_type = CONTENT_TYPES[self._encoder_config.get(CONF_FORMAT, IMAGE_FORMAT_PNG)]
         self._status = CameraStatus.INITIALIZING
         self._should_poll = True
         self._attributes = CONF_AVAILABLE_ATTRIBUTES
-        self._map_data = None
+        self._parsed_map: Optional[ParsedMap] = None
+        self._map_fingerprint = None
+        self._map_cache_hits = 0
+        self._map_cache_misses = 0
+        self._map_frames_superseded = 0
+        self._map_frames_dropped = 0
+        self._map_image_renders = 0
+        self._map_image_encode_time = 0.0
+        self._map_image_size = 0
+        self._map_thumbnail_renders = 0
+        self._render_generation = 0
+        self._render_lock = asyncio.Lock()
         self._image = None
+        self._image_rendered = False
+        self._image_size: Optional[Tuple[int, int]] = None
+        self._thumbnails: Dict[int, bytes] = {}
         self._attr_icon = "mdi:map"
         self._attr_name = "Map"
 
@@ -147,7 +212,89 @@ class VacuumCameraMap(RoborockEntity, Camera):
             self, width: Optional[int] = None, height: Optional[int] = None
     ) -> Optional[bytes]:
         """Returns the image comprised of bytes."""
-        return self._image
+        return self._thumbnails.get(self._get_thumbnail_factor(width, height), self._image)
+
+    async def async_camera_image(
+            self, width: Optional[int] = None, height: Optional[int] = None
+    ) -> Optional[bytes]:
+        """Render the image of the current map on first request and keep it until the map changes.
+
+        Smaller sizes are served from thumbnails reduced by a power of two, kept until the map changes as well.
+        """
+        image = await self._async_get_image()
+        factor = self._get_thumbnail_factor(width, height)
+        if image is None or factor == 1:
+            return image
+        thumbnail = self._thumbnails.get(factor)
+        if thumbnail is None:
+            async with _MAP_PIPELINE:
+                encoded = await self.hass.async_add_executor_job(
+                    reduce_map_image, image, factor, self._encoder_config
+                )
+            self._map_thumbnail_renders += 1
+            thumbnail = encoded.data
+            if image is self._image:
+                self._thumbnails[factor] = thumbnail
+        return thumbnail
+
+    async def _async_get_image(self) -> Optional[bytes]:
+        """Return the image of the current map, rendering it once per map.
+
+        A map that changes while waiting for the render lock is rendered instead. A map that fails to render
+        is not tried again until the payload changes.
+        """
+        while True:
+            parsed_map = self._parsed_map
+            if parsed_map is None or self._image_rendered:
+                return self._image
+            async with self._render_lock, _MAP_PIPELINE:
+                if parsed_map is not self._parsed_map or self._image_rendered:
+                    continue
+                # noinspection PyBroadException
+                try:
+                    encoded = await self._async_run_image_render(parsed_map)
+                except Exception:
+                    _LOGGER.warning("Unable to render map image", exc_info=True)
+                    encoded = None
+                    failed = True
+                else:
+                    self._map_image_renders += 1
+                    failed = False
+                image = self._record_encoded_image(encoded)
+                if parsed_map is self._parsed_map:
+                    if failed:
+                        self._status = CameraStatus.UNABLE_TO_PARSE_MAP
+                    self._image_rendered = True
+                    self._image = image
+                    self._image_size = encoded.size if encoded is not None else None
+                return image
+
+    def _get_thumbnail_factor(self, width: Optional[int], height: Optional[int]) -> int:
+        """Return the largest reduction of the image that still covers the requested size."""
+        if self._image_size is None or (not width and not height):
+            return 1
+        image_width, image_height = self._image_size
+        factor = 1
+        while (
+                factor < THUMBNAIL_MAX_FACTOR
+                and (not width or image_width // (factor * 2) >= width)
+                and (not height or image_height // (factor * 2) >= height)
+        ):
+            factor *= 2
+        return factor
+
+    def _record_encoded_image(self, encoded: Optional[EncodedImage]) -> Optional[bytes]:
+        if encoded is None:
+            return None
+        self._map_image_encode_time = encoded.encode_time
+        self._map_image_size = len(encoded.data)
+        _LOGGER.debug(
+            "Map image encoded as %s in %.1f ms, %s bytes",
+            self.content_type,
+            encoded.encode_time * 1000,
+            len(encoded.data),
+        )
+        return encoded.data
 
     def turn_on(self) -> None:
         """Enable polling for map image."""
@@ -172,10 +319,25 @@ class VacuumCameraMap(RoborockEntity, Camera):
     def extra_state_attributes(self) -> Dict[str, Any]:
         """Return camera attributes."""
         attributes = {}
-        if self._map_data:
-            attributes.update(self.extract_attributes(self._map_data, self._attributes))
+        if self._parsed_map:
+            attributes.update(self._parsed_map.attributes)
+        attributes[ATTRIBUTE_MAP_STATS] = self.map_stats
         return attributes
 
+    @property
+    def map_stats(self) -> Dict[str, float]:
+        """Return counters of the map pipeline."""
+        return {
+            "cache_hits": self._map_cache_hits,
+            "cache_misses": self._map_cache_misses,
+            "frames_superseded": self._map_frames_superseded,
+            "frames_dropped": self._map_frames_dropped,
+            "image_renders": self._map_image_renders,
+            "image_encode_ms": round(self._map_image_encode_time * 1000, 1),
+            "image_bytes": self._map_image_size,
+            "thumbnail_renders": self._map_thumbnail_renders,
+        }
+
     @property
     def is_streaming(self) -> bool:
         """Return true if the device is streaming."""
@@ -189,54 +351,6 @@ class VacuumCameraMap(RoborockEntity, Camera):
         """Return polling enabled."""
         return self._should_poll
 
-    @staticmethod
-    def extract_attributes(
-            map_data: MapData, attributes_to_return: List[str]
-    ) -> Dict[str, Any]:
-        """Extract camera attributes."""
-        attributes = {}
-        rooms = []
-        if map_data.rooms:
-            rooms = dict(
-                filter(
-                    lambda x: x[0],
-                    ((x[0], x[1].name) for x in map_data.rooms.items()),
-                )
-            )
-            if len(rooms) == 0:
-                rooms = list(map_data.rooms.keys())
-        for name, value in {
-            ATTRIBUTE_CALIBRATION: map_data.calibration(),
-            ATTRIBUTE_CARPET_MAP: map_data.carpet_map,
-            ATTRIBUTE_CHARGER: map_data.charger,
-            ATTRIBUTE_CLEANED_ROOMS: map_data.cleaned_rooms,
-            ATTRIBUTE_GOTO: map_data.goto,
-            ATTRIBUTE_GOTO_PATH: map_data.goto_path,
-            ATTRIBUTE_GOTO_PREDICTED_PATH: map_data.predicted_path,
-            ATTRIBUTE_IGNORED_OBSTACLES: map_data.ignored_obstacles,
-            ATTRIBUTE_IGNORED_OBSTACLES_WITH_PHOTO: map_data.ignored_obstacles_with_photo,
-            ATTRIBUTE_IMAGE: map_data.image,
-            ATTRIBUTE_IS_EMPTY: map_data.image.is_empty,
-            ATTRIBUTE_MAP_NAME: map_data.map_name,
-            ATTRIBUTE_MOP_PATH: map_data.mop_path,
-            ATTRIBUTE_NO_CARPET_AREAS: map_data.no_carpet_areas,
-            ATTRIBUTE_NO_GO_AREAS: map_data.no_go_areas,
-            ATTRIBUTE_NO_MOPPING_AREAS: map_data.no_mopping_areas,
-            ATTRIBUTE_OBSTACLES: map_data.obstacles,
-            ATTRIBUTE_OBSTACLES_WITH_PHOTO: map_data.obstacles_with_photo,
-            ATTRIBUTE_PATH: map_data.path,
-            ATTRIBUTE_ROOM_NUMBERS: rooms,
-            ATTRIBUTE_ROOMS: map_data.rooms,
-            ATTRIBUTE_VACUUM_POSITION: map_data.vacuum_position,
-            ATTRIBUTE_VACUUM_ROOM: map_data.vacuum_room,
-            ATTRIBUTE_VACUUM_ROOM_NAME: map_data.vacuum_room_name,
-            ATTRIBUTE_WALLS: map_data.walls,
-            ATTRIBUTE_ZONES: map_data.zones,
-        }.items():
-            if name in attributes_to_return:
-                attributes[name] = value
-        return attributes
-
     async def async_update(self) -> None:
         """Handle map image update."""
         try:
@@ -258,15 +372,8 @@ class VacuumCameraMap(RoborockEntity, Camera):
         except RoborockException:
             self.set_invalid_map()
 
-    async def get_map(
-            self,
-            colors: Colors,
-            drawables: Drawables,
-            texts: Texts,
-            sizes: Sizes,
-            image_config: ImageConfig,
-    ) -> Optional[MapData]:
-        """Get map image."""
+    async def get_map(self, image_config: ImageConfig) -> Optional[ParsedMap]:
+        """Get map data, the image itself is only rendered once requested."""
         response = await self.async_map()
         if response is None:
             return
@@ -275,66 +382,139 @@ class VacuumCameraMap(RoborockEntity, Camera):
                 f"Received non-bytes value for get_map_v1 function: {response}"
             )
             return
-        map_data = self.decode_map(
-            response, colors, drawables, texts, sizes, image_config
-        )
-        return map_data
+        fingerprint = self._get_map_fingerprint(response)
+        if self._parsed_map is not None and fingerprint == self._map_fingerprint:
+            self._map_cache_hits += 1
+            return self._parsed_map
+        self._map_cache_misses += 1
+        parsed_map = await self._async_parse_map(response, image_config)
+        self._map_fingerprint = fingerprint
+        return parsed_map
 
-    def decode_map(
-            self,
-            raw_map: bytes,
-            colors: Colors,
-            drawables: Drawables,
-            texts: Texts,
-            sizes: Sizes,
-            image_config: ImageConfig,
-    ) -> Optional[MapData]:
-        """Decode map image."""
-        return MapDataParserRoborock.parse(
-            raw_map, colors, drawables, texts, sizes, image_config
-        )
+    @staticmethod
+    def _get_map_fingerprint(raw_map: bytes) -> tuple:
+        """Identify a map payload by its header fields and a digest of its bytes."""
+        map_index, map_sequence = MapDataParserRoborock.parse_map_header(raw_map)
+        return map_index, map_sequence, len(raw_map), zlib.crc32(raw_map)
+
+    async def _async_parse_map(self, raw_map: bytes, image_config: ImageConfig) -> ParsedMap:
+        """Parse a map off the event loop.
+
+        Parses are latest-wins: at most one parse per device runs at a time, payloads
+        still waiting when a newer one arrives are dropped, and a finished parse is
+        discarded if a newer payload arrived meanwhile.
+        """
+        self._render_generation += 1
+        generation = self._render_generation
+        args = (image_config, self._attributes)
+        async with self._render_lock, _MAP_PIPELINE:
+            if generation != self._render_generation:
+                self._map_frames_dropped += 1
+                raise MapRenderSuperseded
+            if self._use_render_pool():
+                parsed_map = await self._async_run_in_pool(parse_map, raw_map, *args, False)
+                if parsed_map is not None:
+                    # the payload is kept instead, to parse it again in the pool when the image is requested
+                    parsed_map = parsed_map._replace(raw_map=raw_map)
+            else:
+                parsed_map = None
+            if parsed_map is None:
+                parsed_map = await self.hass.async_add_executor_job(parse_map, raw_map, *args)
+        if generation != self._render_generation:
+            self._map_frames_superseded += 1
+            raise MapRenderSuperseded
+        return parsed_map
+
+    async def _async_run_image_render(self, parsed_map: ParsedMap) -> Optional[EncodedImage]:
+        """Render the image of a parsed map.
+
+        A map parsed in the process pool is not sent back, its model holds views of the payload
+        and would cost more to transfer than to build. The payload is parsed again in the pool instead,
+        so every displayed frame is parsed twice there, once for its attributes and once for its image.
+        """
+        args = (self._colors, self._drawables, self._texts, self._sizes, self._image_config, self._encoder_config,
+                self._device_id)
+        if parsed_map.map_data is None:
+            image = None
+            if self._use_render_pool():
+                image = await self._async_run_in_pool(render_raw_map_image, parsed_map.raw_map, *args)
+            if image is None:
+                image = await self.hass.async_add_executor_job(render_raw_map_image, parsed_map.raw_map, *args)
+            return image
+        return await self.hass.async_add_executor_job(render_map_image, parsed_map.map_data, *args)
+
+    def _use_render_pool(self) -> bool:
+        return self._render_process_pool and _MAP_RENDER_POOL.available
+
+    @staticmethod
+    async def _async_run_in_pool(func: Callable[..., Any], raw_map: bytes, *args: Any) -> Any:
+        future = _MAP_RENDER_POOL.submit(func, raw_map, *args)
+        if future is not None:
+            try:
+                return await asyncio.wrap_future(future)
+            except BrokenProcessPool:
+                # the pool is started again by the next render, this one is run in process
+                pass
+            except (CancelledError, asyncio.CancelledError):
+                # the pool was shut down under the job, by another camera or an unloaded entry,
+                # it is run in process instead, unless this task itself is being cancelled
+                task = asyncio.current_task()
+                if task is not None and task.cancelling():
+                    raise
+        return None
 
     async def _handle_map_data(self):
         _LOGGER.debug("Retrieving map from Roborock MQTT")
-        map_data = await self.get_map(
-            self._colors,
-            self._drawables,
-            self._texts,
-            self._sizes,
-            self._image_config,
-        )
-        if map_data:
+        try:
+            parsed_map = await self.get_map(self._image_config)
+        except MapRenderSuperseded:
+            _LOGGER.debug("Map superseded by a newer payload")
+            return
+        if parsed_map is not None and parsed_map is self._parsed_map:
+            _LOGGER.debug(
+                "Map unchanged, keeping previous image (%s hits, %s misses)",
+                self._map_cache_hits,
+                self._map_cache_misses,
+            )
+        elif parsed_map:
             # noinspection PyBroadException
             try:
                 _LOGGER.debug("Map data retrieved")
-                if map_data.image.is_empty:
+                if parsed_map.is_empty:
                     _LOGGER.debug("Map is empty")
                     self._status = CameraStatus.EMPTY_MAP
-                    if not self._map_data or self._map_data.image.is_empty:
-                        self._set_map_data(map_data)
+                    if not self._parsed_map or self._parsed_map.is_empty:
+                        self._set_map_data(parsed_map)
                 else:
                     _LOGGER.debug("Map is ok")
-                    self._set_map_data(map_data)
+                    self._set_map_data(parsed_map)
                     self._status = CameraStatus.OK
             except Exception:
                 _LOGGER.warning("Unable to parse map data")
                 self._status = CameraStatus.UNABLE_TO_PARSE_MAP
+                self._map_fingerprint = None
         else:
             _LOGGER.warning("Unable to retrieve map data")
             self._status = CameraStatus.UNABLE_TO_RETRIEVE_MAP
 
-    def _set_map_data(self, map_data: MapData):
-        img_byte_arr = io.BytesIO()
-        map_data.image.data.save(img_byte_arr, format="PNG")
-        self._image = img_byte_arr.getvalue()
-        self._map_data = map_data
+    def _set_map_data(self, parsed_map: ParsedMap):
+        # the image of the previous map is dropped, the new one is rendered on the next request
+        self._image = None
+        self._image_rendered = False
+        self._image_size = None
+        self._thumbnails = {}
+        self._parsed_map = parsed_map
         device_info = self.coordinator.device_info
-        if device_info is not None and device_info.current_room != map_data.vacuum_room:
+        if device_info is not None and device_info.current_room != parsed_map.vacuum_room:
             device_info.room_mapping = None
-            device_info.current_room = map_data.vacuum_room
+            device_info.current_room = parsed_map.vacuum_room
             self.schedule_update_ha_state(force_refresh=True)
 
 
+class MapRenderSuperseded(Exception):
+    """Raised when a map render was superseded by a newer payload."""
+
+
 class CameraStatus(Enum):
     """Camera status enum."""
 
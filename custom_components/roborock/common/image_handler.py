@@ -1,17 +1,27 @@
 import logging
 import math
-from typing import Tuple, List, Dict, Set
+import threading
+from collections import Counter, OrderedDict
+from typing import Any, Tuple, List, Dict, Optional, Set
 from collections.abc import Callable
+from functools import partial
 
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from PIL.Image import Image as ImageType
 
-from custom_components.roborock.common.map_data import ImageData, Path, Area, Wall, Zone, Point, Obstacle, Room
-from custom_components.roborock.common.types import Colors, ImageConfig, Sizes, Color, Texts
+from custom_components.roborock.common.map_data import (ImageData, Path, Area, Wall, Zone, Point, Obstacle, Room,
+                                                         CarpetMap)
+from custom_components.roborock.common.types import Colors, Drawables, ImageConfig, Sizes, Color, Texts
 from custom_components.roborock.const import *
 
 _LOGGER = logging.getLogger(__name__)
 
+# (drawable, element, signature, bounds) of an element that is drawn on every frame
+DynamicPart = Tuple[str, Any, int, Tuple[int, int, int, int]]
+# (image, anchor x, anchor y, opaque) of a pre-rendered element, the anchor is placed at the position of the element
+Sprite = Tuple[ImageType, float, float, bool]
+
 
 class ImageHandlerRoborock:
     MAP_OUTSIDE = 0x00
@@ -73,6 +83,18 @@ class ImageHandlerRoborock:
     ROOM_COLORS = [COLOR_ROOM_1, COLOR_ROOM_2, COLOR_ROOM_3, COLOR_ROOM_4, COLOR_ROOM_5, COLOR_ROOM_6, COLOR_ROOM_7,
                    COLOR_ROOM_8, COLOR_ROOM_9, COLOR_ROOM_10, COLOR_ROOM_11, COLOR_ROOM_12, COLOR_ROOM_13,
                    COLOR_ROOM_14, COLOR_ROOM_15, COLOR_ROOM_16]
+    ROTATIONS = {90: Image.ROTATE_90, 180: Image.ROTATE_180, 270: Image.ROTATE_270}
+    _lut_cache: Dict[tuple, np.ndarray] = {}
+    # least recently used entries are dropped first, so that the maps of other vacuums stay cached
+    _base_layer_cache: OrderedDict[tuple, ImageType] = OrderedDict()
+    _frame_cache: OrderedDict[tuple, Tuple[ImageType, Counter, tuple]] = OrderedDict()
+    _cache_lock = threading.Lock()
+    _sprite_cache: Dict[tuple, Sprite] = {}
+    TILE_SIZE = 64
+    BASE_LAYER_CACHE_SIZE = 4
+    FRAME_CACHE_SIZE = 4
+    SPRITE_CACHE_SIZE = 256
+    VACUUM_ANGLE_STEP = 5
 
     @staticmethod
     def create_empty_map_image(colors: Colors, text: str = "NO MAP") -> ImageType:
@@ -83,7 +105,7 @@ class ImageHandlerRoborock:
         else:
             text_color = (255, 255, 255)
         draw = ImageDraw.Draw(image, "RGBA")
-        w, h = draw.textsize(text)
+        _, _, w, h = draw.textbbox((0, 0), text)
         draw.text(((image.size[0] - w) / 2, (image.size[1] - h) / 2), text, fill=text_color)
         return image
 
@@ -123,6 +145,9 @@ class ImageHandlerRoborock:
 
     @staticmethod
     def draw_walls(image: ImageData, walls: List[Wall], colors: Colors):
+        if len(walls) == 0:
+            return
+        ImageHandlerRoborock.__to_rgba__(image)
         draw = ImageDraw.Draw(image.data, "RGBA")
         for wall in walls:
             draw.line(wall.to_img(image.dimensions).as_list(),
@@ -169,8 +194,13 @@ class ImageHandlerRoborock:
     @staticmethod
     def draw_all_obstacles(image: ImageData, obstacles: List[Obstacle], radius: float, color: Color, colors: Colors):
         outline_color = ImageHandlerRoborock.__get_color__(COLOR_OBSTACLE_OUTLINE, colors)
+        primitives = []
         for obstacle in obstacles:
-            ImageHandlerRoborock.__draw_circle__(image, obstacle, radius, outline_color, color)
+            point = obstacle.to_img(image.dimensions)
+            coords = [point.x - radius, point.y - radius, point.x + radius, point.y + radius]
+            primitives.append((coords, partial(ImageDraw.ImageDraw.ellipse, outline=outline_color, fill=color)))
+        ImageHandlerRoborock.__draw_all_on_new_layer__(image, primitives,
+                                                       ImageHandlerRoborock.__use_transparency__(outline_color, color))
 
     @staticmethod
     def draw_vacuum_position(image: ImageData, vacuum_position: Point, sizes: Sizes, colors: Colors):
@@ -189,13 +219,109 @@ class ImageHandlerRoborock:
                 ImageHandlerRoborock.__draw_text__(image, room.name, point.x, point.y, color)
 
     @staticmethod
-    def rotate(image: ImageData):
-        if image.dimensions.rotation == 90:
-            image.data = image.data.transpose(Image.ROTATE_90)
-        if image.dimensions.rotation == 180:
-            image.data = image.data.transpose(Image.ROTATE_180)
-        if image.dimensions.rotation == 270:
-            image.data = image.data.transpose(Image.ROTATE_270)
+    def get_render_key(colors: Colors, drawables: Drawables, sizes: Sizes, image_config: ImageConfig) -> str:
+        return repr((sorted(colors.items()), list(drawables), sorted(sizes.items()),
+                     sorted((key, sorted(value.items()) if isinstance(value, dict) else value)
+                            for key, value in image_config.items())))
+
+    @staticmethod
+    def get_base_layer(key: tuple) -> Optional[ImageType]:
+        base = ImageHandlerRoborock.__get_cached__(ImageHandlerRoborock._base_layer_cache, key)
+        return base.copy() if base is not None else None
+
+    @staticmethod
+    def set_base_layer(key: tuple, base: ImageType):
+        ImageHandlerRoborock.__set_cached__(ImageHandlerRoborock._base_layer_cache, key, base.copy(),
+                                            ImageHandlerRoborock.BASE_LAYER_CACHE_SIZE)
+
+    @staticmethod
+    def __get_cached__(cache: OrderedDict, key: tuple) -> Any:
+        with ImageHandlerRoborock._cache_lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    @staticmethod
+    def __set_cached__(cache: OrderedDict, key: tuple, value: Any, size: int):
+        with ImageHandlerRoborock._cache_lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > size:
+                cache.popitem(last=False)
+
+    @staticmethod
+    def get_bounds(image: ImageData, points: List[Point], padding: float) -> Tuple[int, int, int, int]:
+        # the transformation to the image is monotonic in both axes, so the corners are enough
+        xs = [p.x for p in points]
+        ys = [p.y for p in points]
+        p0 = Point(min(xs), min(ys)).to_img(image.dimensions)
+        p1 = Point(max(xs), max(ys)).to_img(image.dimensions)
+        return ImageHandlerRoborock.__get_bounds__([min(p0.x, p1.x) - padding, min(p0.y, p1.y) - padding,
+                                                    max(p0.x, p1.x) + padding, max(p0.y, p1.y) + padding])
+
+    @staticmethod
+    def draw_on_tiles(image: ImageData, key: tuple, base_key: tuple, parts: List[DynamicPart],
+                      draw_parts: Callable[[ImageData, List[DynamicPart]], None]):
+        # image.data has to be the base layer of base_key, the previous frame of the same key is reused for every tile
+        # where neither the base layer changed nor a part was added or removed, the other tiles are drawn again
+        current = Counter((part[0], part[2], part[3]) for part in parts)
+        previous = ImageHandlerRoborock.__get_cached__(ImageHandlerRoborock._frame_cache, key)
+        dirty = None
+        # previous frames without any part are not drawn over, they may still be palette images
+        if previous is not None and previous[0].size == image.data.size and previous[0].mode == "RGBA":
+            dirty = ImageHandlerRoborock.__get_changed_tiles__(previous[2], base_key)
+        if dirty is not None:
+            for _, _, bounds in (previous[1] - current) + (current - previous[1]):
+                dirty.update(ImageHandlerRoborock.__get_tiles__(image, bounds))
+            columns, rows = (math.ceil(d / ImageHandlerRoborock.TILE_SIZE) for d in image.data.size)
+            if len(dirty) * 2 > columns * rows:
+                dirty = None
+        if dirty is None:
+            draw_parts(image, parts)
+        elif len(dirty) == 0:
+            image.data = previous[0].copy()
+        else:
+            draw_parts(image, [p for p in parts if not dirty.isdisjoint(ImageHandlerRoborock.__get_tiles__(image, p[3]))])
+            frame = previous[0].copy()
+            size = ImageHandlerRoborock.TILE_SIZE
+            for column, row in dirty:
+                box = (column * size, row * size, (column + 1) * size, (row + 1) * size)
+                frame.paste(image.data.crop(box), box)
+            image.data = frame
+        ImageHandlerRoborock.__set_cached__(ImageHandlerRoborock._frame_cache, key,
+                                            (image.data.copy(), current, base_key),
+                                            ImageHandlerRoborock.FRAME_CACHE_SIZE)
+
+    @staticmethod
+    def __get_changed_tiles__(previous_key: tuple, key: tuple) -> Optional[Set[Tuple[int, int]]]:
+        # tiles where the cached base layers differ, None when they cannot be compared
+        if previous_key == key:
+            return set()
+        previous = ImageHandlerRoborock.__get_cached__(ImageHandlerRoborock._base_layer_cache, previous_key)
+        current = ImageHandlerRoborock.__get_cached__(ImageHandlerRoborock._base_layer_cache, key)
+        if previous is None or current is None or previous.size != current.size or previous.mode != current.mode \
+                or previous.getpalette("RGBA") != current.getpalette("RGBA"):
+            return None
+        changed = np.asarray(previous) != np.asarray(current)
+        if changed.ndim == 3:
+            changed = changed.any(axis=2)
+        size = ImageHandlerRoborock.TILE_SIZE
+        rows, columns = (math.ceil(d / size) for d in changed.shape)
+        tiles = np.zeros((rows * size, columns * size), dtype=bool)
+        tiles[:changed.shape[0], :changed.shape[1]] = changed
+        tiles = tiles.reshape(rows, size, columns, size).any(axis=(1, 3))
+        return {(int(column), int(row)) for row, column in np.argwhere(tiles)}
+
+    @staticmethod
+    def __get_tiles__(image: ImageData, bounds: Tuple[int, int, int, int]) -> Set[Tuple[int, int]]:
+        size = ImageHandlerRoborock.TILE_SIZE
+        width, height = image.data.size
+        left = max(bounds[0], 0) // size
+        top = max(bounds[1], 0) // size
+        right = (min(bounds[2], width) - 1) // size
+        bottom = (min(bounds[3], height) - 1) // size
+        return {(column, row) for column in range(left, right + 1) for row in range(top, bottom + 1)}
 
     @staticmethod
     def draw_texts(image: ImageData, texts: Texts):
@@ -215,10 +341,20 @@ class ImageHandlerRoborock:
 
     @staticmethod
     def __draw_vacuum__(image: ImageData, vacuum_pos, r, outline, fill):
-        def draw_func(draw: ImageDraw):
-            if vacuum_pos.a is None:
-                vacuum_pos.a = 0
-            point = vacuum_pos.to_img(image.dimensions)
+        if vacuum_pos.a is None:
+            vacuum_pos.a = 0
+        # the robot is drawn once per angle step, turned by the rotation of the image
+        a = vacuum_pos.a + image.dimensions.rotation
+        a = round(a / ImageHandlerRoborock.VACUUM_ANGLE_STEP) * ImageHandlerRoborock.VACUUM_ANGLE_STEP % 360
+        sprite = ImageHandlerRoborock.__get_sprite__(
+            ("vacuum", r, outline, fill, a),
+            lambda: ImageHandlerRoborock.__create_vacuum_sprite__(r, a, outline, fill))
+        point = vacuum_pos.to_img(image.dimensions)
+        ImageHandlerRoborock.__draw_sprite__(image, sprite, point.x, point.y)
+
+    @staticmethod
+    def __create_vacuum_sprite__(r, a, outline, fill) -> Sprite:
+        def draw_func(draw: ImageDraw, point: Point):
             r_scaled = r / 16
             # main outline
             coords = [point.x - r, point.y - r, point.x + r, point.y + r]
@@ -231,8 +367,8 @@ class ImageHandlerRoborock:
                 coords = [x - r2, y - r2, x + r2, y + r2]
                 draw.ellipse(coords, outline=outline, fill=None)
             # bin cover
-            a1 = (vacuum_pos.a + 104) / 180 * math.pi
-            a2 = (vacuum_pos.a - 104) / 180 * math.pi
+            a1 = (a + 104) / 180 * math.pi
+            a2 = (a - 104) / 180 * math.pi
             r2 = r_scaled * 13
             x1 = point.x - r2 * math.cos(a1)
             y1 = point.y + r2 * math.sin(a1)
@@ -240,7 +376,7 @@ class ImageHandlerRoborock:
             y2 = point.y + r2 * math.sin(a2)
             draw.line([x1, y1, x2, y2], width=1, fill=outline)
             # lidar
-            angle = vacuum_pos.a / 180 * math.pi
+            angle = a / 180 * math.pi
             r2 = r_scaled * 3
             x = point.x + r2 * math.cos(angle)
             y = point.y - r2 * math.sin(angle)
@@ -260,89 +396,139 @@ class ImageHandlerRoborock:
             coords = [x - r2, y - r2, x + r2, y + r2]
             draw.ellipse(coords, outline=half_color, fill=half_color)
 
-        ImageHandlerRoborock.__draw_on_new_layer__(image, draw_func, 1,
-                                                   ImageHandlerRoborock.__use_transparency__(outline, fill))
-
-    @staticmethod
-    def __draw_circle__(image: ImageData, center: Point, r: float, outline: Color, fill: Color):
-        def draw_func(draw: ImageDraw):
-            point = center.to_img(image.dimensions)
-            coords = [point.x - r, point.y - r, point.x + r, point.y + r]
-            draw.ellipse(coords, outline=outline, fill=fill)
-
-        ImageHandlerRoborock.__draw_on_new_layer__(image, draw_func, 1,
-                                                   ImageHandlerRoborock.__use_transparency__(outline, fill))
+        return ImageHandlerRoborock.__create_round_sprite__(r, draw_func)
 
     @staticmethod
     def __draw_pieslice__(image: ImageData, position, r, outline, fill):
-        def draw_func(draw: ImageDraw):
-            point = position.to_img(image.dimensions)
-            angle = -position.a if position.a is not None else 0
+        angle = (-position.a if position.a is not None else 0) - image.dimensions.rotation
+
+        def draw_func(draw: ImageDraw, point: Point):
             coords = [point.x - r, point.y - r, point.x + r, point.y + r]
             draw.pieslice(coords, angle + 90, angle - 90, outline="black", fill=fill)
 
-        ImageHandlerRoborock.__draw_on_new_layer__(image, draw_func, 1,
-                                                   ImageHandlerRoborock.__use_transparency__(outline, fill))
+        sprite = ImageHandlerRoborock.__get_sprite__(
+            ("pieslice", r, outline, fill, angle),
+            lambda: ImageHandlerRoborock.__create_round_sprite__(r, draw_func))
+        point = position.to_img(image.dimensions)
+        ImageHandlerRoborock.__draw_sprite__(image, sprite, point.x, point.y)
 
     @staticmethod
     def __draw_areas__(image: ImageData, areas: List[Area], fill: Color, outline: Color):
         if len(areas) == 0:
             return
 
-        use_transparency = ImageHandlerRoborock.__use_transparency__(outline, fill)
+        primitives = []
         for area in areas:
-            current_area = area
-            def draw_func(draw: ImageDraw):
-                draw.polygon(current_area.to_img(image.dimensions).as_list(), fill, outline)
-
-            ImageHandlerRoborock.__draw_on_new_layer__(image, draw_func, 1, use_transparency)
+            coords = area.to_img(image.dimensions).as_list()
+            primitives.append((coords, partial(ImageDraw.ImageDraw.polygon, fill=fill, outline=outline)))
+        ImageHandlerRoborock.__draw_all_on_new_layer__(image, primitives,
+                                                       ImageHandlerRoborock.__use_transparency__(outline, fill))
 
     @staticmethod
     def __draw_path__(image: ImageData, path: Path, path_width: int, color: Color, scale: float):
         if len(path.path) < 1:
             return
 
-        def draw_func(draw: ImageDraw):
-            for current_path in path.path:
-                if len(current_path) > 1:
-                    s = current_path[0].to_img(image.dimensions)
-                    coords = None
-                    for point in current_path[1:]:
-                        e = point.to_img(image.dimensions)
-                        sx = s.x * scale
-                        sy = s.y * scale
-                        ex = e.x * scale
-                        ey = e.y * scale
-                        draw.line([sx, sy, ex, ey], width=int(scale * path_width), fill=color)
-                        if path_width > 4:
-                            r = scale * path_width / 2
-                            if not coords:
-                                coords = [sx - r, sy - r, sx + r, sy + r]
-                                draw.pieslice(coords, 0, 360, outline=color, fill=color)
-                            coords = [ex - r, ey - r, ex + r, ey + r]
-                            draw.pieslice(coords, 0, 360, outline=color, fill=color)
-                        s = e
-
-        ImageHandlerRoborock.__draw_on_new_layer__(image, draw_func, scale,
-                                                   ImageHandlerRoborock.__use_transparency__(color))
+        sub_paths = []
+        for current_path in path.path:
+            if len(current_path) > 1:
+                sub_paths.append(image.dimensions.to_img_array(current_path))
+        if len(sub_paths) == 0:
+            return
+        r = path_width / 2
+        all_points = np.concatenate(sub_paths)
+        bounds = ImageHandlerRoborock.__get_bounds__([*(all_points.min(axis=0) - r), *(all_points.max(axis=0) + r)])
+
+        def draw_func(draw: ImageDraw, left: int, top: int):
+            width = int(scale * path_width)
+            r_scaled = scale * r
+            for sub_path in sub_paths:
+                if path_width > 4:
+                    sub_path = ImageHandlerRoborock.__get_path_joints__(sub_path)
+                points = sub_path * scale - (left, top)
+                draw.line(points.ravel().tolist(), width=width, fill=color)
+                if path_width > 4:
+                    for x, y in points.tolist():
+                        draw.ellipse([x - r_scaled, y - r_scaled, x + r_scaled, y + r_scaled], fill=color)
+
+        ImageHandlerRoborock.__draw_on_bounded_layer__(image, draw_func, bounds, scale,
+                                                       ImageHandlerRoborock.__use_transparency__(color))
+
+    @staticmethod
+    def __get_path_joints__(points: np.ndarray) -> np.ndarray:
+        # points are recorded much denser than the pixels of the map, wide paths keep a single point
+        # with a round joint for consecutive points within the same pixel, the last point is always kept,
+        # the pixels are those of the image, so the points kept do not depend on the layer they are drawn on
+        pixels = np.rint(points)
+        moved = np.any(pixels[1:] != pixels[:-1], axis=1)
+        keep = np.concatenate(([True], moved))
+        keep[-1] = True
+        return points[keep]
 
     @staticmethod
     def __draw_text__(image: ImageData, text: str, x: float, y: float, color: Color, font_file=None, font_size=None):
-        def draw_func(draw: ImageDraw):
-            font = ImageFont.load_default()
-            try:
-                if font_file is not None and font_size > 0:
-                    font = ImageFont.truetype(font_file, font_size)
-            except OSError:
-                _LOGGER.warning("Unable to find font file: %s", font_file)
-            except ImportError:
-                _LOGGER.warning("Unable to open font: %s", font_file)
-            finally:
-                w, h = draw.textsize(text, font)
-                draw.text((x - w / 2, y - h / 2), text, font=font, fill=color)
-
-        ImageHandlerRoborock.__draw_on_new_layer__(image, draw_func, 1,
-                                                   ImageHandlerRoborock.__use_transparency__(color))
+        sprite = ImageHandlerRoborock.__get_sprite__(
+            ("text", text, font_file, font_size, color),
+            lambda: ImageHandlerRoborock.__create_text_sprite__(text, color, font_file, font_size))
+        ImageHandlerRoborock.__draw_sprite__(image, sprite, x, y)
+
+    @staticmethod
+    def __create_text_sprite__(text: str, color: Color, font_file, font_size) -> Sprite:
+        font = ImageFont.load_default()
+        try:
+            if font_file is not None and font_size > 0:
+                font = ImageFont.truetype(font_file, font_size)
+        except OSError:
+            _LOGGER.warning("Unable to find font file: %s", font_file)
+        except ImportError:
+            _LOGGER.warning("Unable to open font: %s", font_file)
+        _, _, w, h = ImageDraw.Draw(Image.new("RGBA", (1, 1))).textbbox((0, 0), text, font)
+        layer = Image.new("RGBA", (max(w, 1), max(h, 1)), (255, 255, 255, 0))
+        ImageDraw.Draw(layer, "RGBA").text((0, 0), text, font=font, fill=color)
+        return layer, w / 2, h / 2, ImageHandlerRoborock.__is_opaque__(layer)
+
+    @staticmethod
+    def __create_round_sprite__(r: float, draw_function: Callable) -> Sprite:
+        center = math.ceil(r) + 1
+        layer = Image.new("RGBA", (2 * center + 1, 2 * center + 1), (255, 255, 255, 0))
+        draw_function(ImageDraw.Draw(layer, "RGBA"), Point(center, center))
+        return layer, center, center, ImageHandlerRoborock.__is_opaque__(layer)
+
+    @staticmethod
+    def __is_opaque__(layer: ImageType) -> bool:
+        # every pixel is either fully transparent or fully opaque
+        return sum(layer.getchannel("A").histogram()[1:255]) == 0
+
+    @staticmethod
+    def __get_sprite__(key: tuple, create_sprite: Callable[[], Sprite]) -> Sprite:
+        sprite = ImageHandlerRoborock._sprite_cache.get(key)
+        if sprite is None:
+            if len(ImageHandlerRoborock._sprite_cache) >= ImageHandlerRoborock.SPRITE_CACHE_SIZE:
+                ImageHandlerRoborock._sprite_cache.clear()
+            sprite = create_sprite()
+            ImageHandlerRoborock._sprite_cache[key] = sprite
+        return sprite
+
+    @staticmethod
+    def __draw_sprite__(image: ImageData, sprite: Sprite, x: float, y: float):
+        # sprites are drawn on transparent layers, so compositing them matches drawing them on a layer of the map
+        layer, anchor_x, anchor_y, opaque = sprite
+        left = round(x - anchor_x)
+        top = round(y - anchor_y)
+        if opaque:
+            # masking with an alpha of only 0 and 255 gives the same pixels as compositing, but is faster
+            ImageHandlerRoborock.__to_rgba__(image)
+            image.data.paste(layer, (left, top), layer)
+            return
+        source_left = max(-left, 0)
+        source_top = max(-top, 0)
+        source_right = min(layer.size[0], image.data.size[0] - left)
+        source_bottom = min(layer.size[1], image.data.size[1] - top)
+        if source_left >= source_right or source_top >= source_bottom:
+            return
+        ImageHandlerRoborock.__to_rgba__(image)
+        image.data.alpha_composite(layer, (left + source_left, top + source_top),
+                                   (source_left, source_top, source_right, source_bottom))
 
     @staticmethod
     def __get_color__(name, colors: Colors, default_name: str = None) -> Color:
@@ -353,91 +539,287 @@ class ImageHandlerRoborock:
         return ImageHandlerRoborock.COLORS[default_name]
 
     @staticmethod
-    def __draw_on_new_layer__(image: ImageData, draw_function: Callable, scale: float = 1, use_transparency=False):
+    def __draw_all_on_new_layer__(image: ImageData, primitives: List[Tuple[List[float], Callable]],
+                                  use_transparency=False):
+        # primitives are (xy, draw function) pairs, the draw function gets xy as a keyword argument,
+        # primitives that do not overlap share one layer, so the result is the same as compositing
+        # every primitive on its own
+        if len(primitives) == 0:
+            return
+        ImageHandlerRoborock.__to_rgba__(image)
+        if not use_transparency:
+            draw = ImageDraw.Draw(image.data, "RGBA")
+            for xy, draw_function in primitives:
+                draw_function(draw, xy=xy)
+            return
+        batch = []
+        batch_bounds = []
+        for xy, draw_function in primitives:
+            bounds = ImageHandlerRoborock.__get_bounds__(xy)
+            if any(ImageHandlerRoborock.__overlaps__(bounds, other) for other in batch_bounds):
+                ImageHandlerRoborock.__draw_batch__(image, batch, batch_bounds)
+                batch = []
+                batch_bounds = []
+            batch.append((xy, draw_function))
+            batch_bounds.append(bounds)
+        ImageHandlerRoborock.__draw_batch__(image, batch, batch_bounds)
+
+    @staticmethod
+    def __draw_batch__(image: ImageData, batch: List[Tuple[List[float], Callable]],
+                       batch_bounds: List[Tuple[int, int, int, int]]):
+        if len(batch) == 0:
+            return
+        bounds = (min(b[0] for b in batch_bounds), min(b[1] for b in batch_bounds),
+                  max(b[2] for b in batch_bounds), max(b[3] for b in batch_bounds))
+
+        def draw_func(draw: ImageDraw, left: int, top: int):
+            for xy, draw_function in batch:
+                draw_function(draw, xy=[v - (left if i % 2 == 0 else top) for i, v in enumerate(xy)])
+
+        ImageHandlerRoborock.__draw_on_bounded_layer__(image, draw_func, bounds, 1, True)
+
+    @staticmethod
+    def __get_bounds__(xy: List[float]) -> Tuple[int, int, int, int]:
+        # one pixel of margin for the outline and rounding of the coordinates, right and bottom are exclusive
+        xs = xy[0::2]
+        ys = xy[1::2]
+        return math.floor(min(xs)) - 1, math.floor(min(ys)) - 1, math.ceil(max(xs)) + 2, math.ceil(max(ys)) + 2
+
+    @staticmethod
+    def __overlaps__(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> bool:
+        return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+    @staticmethod
+    def __draw_on_bounded_layer__(image: ImageData, draw_function: Callable, bounds: Tuple[int, int, int, int],
+                                  scale: float = 1, use_transparency=False):
+        # draw_function gets the position of the layer in its own pixels, points are drawn at point * scale - position,
+        # only the bounds are supersampled and composited
+        width, height = image.data.size
+        left = max(bounds[0], 0)
+        top = max(bounds[1], 0)
+        right = min(bounds[2], width)
+        bottom = min(bounds[3], height)
+        if left >= right or top >= bottom:
+            return
+        ImageHandlerRoborock.__to_rgba__(image)
         if scale == 1 and not use_transparency:
             draw = ImageDraw.Draw(image.data, "RGBA")
-            draw_function(draw)
-        else:
-            size = (int(image.data.size[0] * scale), int(image.data.size[1] * scale))
+            draw_function(draw, 0, 0)
+            return
+        size = (right - left, bottom - top)
+        if scale == 1:
             layer = Image.new("RGBA", size, (255, 255, 255, 0))
-            draw = ImageDraw.Draw(layer, "RGBA")
-            draw_function(draw)
-            if scale != 1:
-                layer = layer.resize(image.data.size, resample=Image.BOX)
-            ImageHandlerRoborock.__draw_layer__(image, layer)
+            draw_function(ImageDraw.Draw(layer, "RGBA"), left, top)
+            image.data.alpha_composite(layer, (left, top))
+            return
+        # the layer is a part of a layer of the whole image scaled by scale, and it is scaled back as that one would be,
+        # so the pixels do not depend on the bounds, parts drawn again on later frames match the ones drawn before
+        scaled_width, scaled_height = int(width * scale), int(height * scale)
+        if scaled_width == 0 or scaled_height == 0:
+            return
+        xs, x_counts = ImageHandlerRoborock.__get_scaled_pixels__(left, right, width, scaled_width)
+        ys, y_counts = ImageHandlerRoborock.__get_scaled_pixels__(top, bottom, height, scaled_height)
+        layer_left = int(xs[0])
+        layer_top = int(ys[0])
+        layer = Image.new("RGBA", (int(xs[-1] + x_counts[-1]) - layer_left, int(ys[-1] + y_counts[-1]) - layer_top),
+                          (255, 255, 255, 0))
+        draw_function(ImageDraw.Draw(layer, "RGBA"), layer_left, layer_top)
+        layer = ImageHandlerRoborock.__scale_layer__(layer, xs - layer_left, x_counts, ys - layer_top, y_counts)
+        image.data.alpha_composite(layer, (left, top))
+
+    @staticmethod
+    def __get_scaled_pixels__(start: int, end: int, size: int, scaled_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        # first pixel and number of pixels of a layer scaled from size to scaled_size for the pixels start..end of the
+        # image, as in a box filter: the ones with centers inside of the pixel, or the one under its center,
+        # computed on integers, as the rounding of the filter of Pillow depends on the position of the layer
+        pixels = np.arange(start, end + 1, dtype=np.int64)
+        if scaled_size < size:
+            first = (2 * pixels[:-1] + 1) * scaled_size // (2 * size)
+            return first, np.ones_like(first)
+        edges = (2 * pixels * scaled_size - size) // (2 * size) + 1
+        return edges[:-1], np.diff(edges)
+
+    @staticmethod
+    def __scale_layer__(layer: ImageType, xs: np.ndarray, x_counts: np.ndarray, ys: np.ndarray,
+                        y_counts: np.ndarray) -> ImageType:
+        # averages the pixels with premultiplied alpha, as Pillow does
+        pixels = np.asarray(layer.convert("RGBa"))
+        sums = ImageHandlerRoborock.__sum_pixels__(pixels, ys, y_counts, 0)
+        sums = ImageHandlerRoborock.__sum_pixels__(sums, xs, x_counts, 1)
+        counts = np.outer(y_counts, x_counts).astype(np.uint16)[:, :, None]
+        scaled = ((2 * sums + counts) // (2 * counts)).astype(np.uint8)
+        return Image.fromarray(scaled, "RGBa").convert("RGBA")
+
+    @staticmethod
+    def __sum_pixels__(pixels: np.ndarray, first: np.ndarray, counts: np.ndarray, axis: int) -> np.ndarray:
+        # sums counts pixels from first along the axis, a pixel at a time, which is much faster than np.add.reduceat
+        sums = np.take(pixels, first, axis=axis).astype(np.uint16)
+        shape = [1, 1, 1]
+        shape[axis] = -1
+        for i in range(1, int(counts.max())):
+            sums += np.take(pixels, first + np.minimum(i, counts - 1), axis=axis) * (i < counts).reshape(shape)
+        return sums
+
+    @staticmethod
+    def __to_rgba__(image: ImageData):
+        # the map is drawn as a palette image, it is converted once the first overlay is drawn on it
+        if image.data.mode != "RGBA":
+            image.data = image.data.convert("RGBA")
 
     @staticmethod
     def __draw_layer__(image: ImageData, layer: ImageType):
+        ImageHandlerRoborock.__to_rgba__(image)
         image.data = Image.alpha_composite(image.data, layer)
 
     @staticmethod
-    def parse(raw_data: bytes, width: int, height: int, carpet_map: Set[int], colors: Colors,
-              image_config: ImageConfig) -> Tuple[ImageType, dict]:
-        rooms = {}
-        scale = image_config[CONF_SCALE]
+    def __get_lut__(colors: Colors) -> np.ndarray:
+        key = tuple(sorted((name, tuple(color)) for name, color in colors.items()))
+        lut = ImageHandlerRoborock._lut_cache.get(key)
+        if lut is not None:
+            return lut
+        lut = np.zeros((256, 4), dtype=np.uint8)
+        for pixel_type in range(256):
+            if pixel_type == ImageHandlerRoborock.MAP_OUTSIDE:
+                color = ImageHandlerRoborock.__get_color__(COLOR_MAP_OUTSIDE, colors)
+            elif pixel_type == ImageHandlerRoborock.MAP_WALL:
+                color = ImageHandlerRoborock.__get_color__(COLOR_MAP_WALL, colors)
+            elif pixel_type == ImageHandlerRoborock.MAP_INSIDE:
+                color = ImageHandlerRoborock.__get_color__(COLOR_MAP_INSIDE, colors)
+            elif pixel_type == ImageHandlerRoborock.MAP_SCAN:
+                color = ImageHandlerRoborock.__get_color__(COLOR_SCAN, colors)
+            else:
+                obstacle = pixel_type & 0x07
+                if obstacle == 0:
+                    color = ImageHandlerRoborock.__get_color__(COLOR_GREY_WALL, colors)
+                elif obstacle == 1:
+                    color = ImageHandlerRoborock.__get_color__(COLOR_MAP_WALL_V2, colors)
+                elif obstacle == 7:
+                    room_number = pixel_type >> 3
+                    default = ImageHandlerRoborock.ROOM_COLORS[room_number >> 1]
+                    color = ImageHandlerRoborock.__get_color__(f"{COLOR_ROOM_PREFIX}{room_number}", colors, default)
+                else:
+                    color = ImageHandlerRoborock.__get_color__(COLOR_UNKNOWN, colors)
+            lut[pixel_type] = (*color, 255) if len(color) == 3 else color
+        if len(ImageHandlerRoborock._lut_cache) >= 8:
+            ImageHandlerRoborock._lut_cache.clear()
+        ImageHandlerRoborock._lut_cache[key] = lut
+        return lut
+
+    @staticmethod
+    def __get_room_bounds__(pixels: np.ndarray, left: int, top: int) -> Dict[int, Tuple[int, int, int, int]]:
+        is_room = ((pixels & 0x07) == 0x07) & (pixels != ImageHandlerRoborock.MAP_SCAN) \
+            & (pixels != ImageHandlerRoborock.MAP_INSIDE)
+        labels = np.where(is_room, pixels >> 3, 0)
+        height, width = labels.shape
+        in_rows = np.zeros((32, height), dtype=bool)
+        in_cols = np.zeros((32, width), dtype=bool)
+        in_rows[labels, np.arange(height)[:, None]] = True
+        in_cols[labels, np.arange(width)[None, :]] = True
+        found = []
+        for room_number in np.flatnonzero(in_rows[1:].any(axis=1)) + 1:
+            rows = np.flatnonzero(in_rows[room_number])
+            cols = np.flatnonzero(in_cols[room_number])
+            first_x = int(np.argmax(labels[rows[0]] == room_number))
+            found.append(((rows[0], first_x), int(room_number),
+                          (int(cols[0]) + left, int(rows[0]) + top, int(cols[-1]) + left, int(rows[-1]) + top)))
+        # keep the order in which a row-major scan of the map meets each room
+        return {room_number: bounds for _, room_number, bounds in sorted(found)}
+
+    @staticmethod
+    def __get_trimmed_pixels__(raw_data: bytes, width: int, height: int,
+                               image_config: ImageConfig) -> Tuple[np.ndarray, int, int]:
         trim_left = int(image_config[CONF_TRIM][CONF_LEFT] * width / 100)
         trim_right = int(image_config[CONF_TRIM][CONF_RIGHT] * width / 100)
         trim_top = int(image_config[CONF_TRIM][CONF_TOP] * height / 100)
         trim_bottom = int(image_config[CONF_TRIM][CONF_BOTTOM] * height / 100)
         trimmed_height = height - trim_top - trim_bottom
         trimmed_width = width - trim_left - trim_right
-        image = Image.new("RGBA", (trimmed_width, trimmed_height))
+        raw = np.frombuffer(raw_data, dtype=np.uint8, count=width * height).reshape(height, width)
+        pixels = raw[trim_bottom:trim_bottom + trimmed_height, trim_left:trim_left + trimmed_width]
+        return pixels, trim_left, trim_bottom
+
+    @staticmethod
+    def parse_rooms(raw_data: bytes, width: int, height: int, image_config: ImageConfig) -> dict:
         if width == 0 or height == 0:
-            return ImageHandlerRoborock.create_empty_map_image(colors), {}
-        pixels = image.load()
-        for img_y in range(trimmed_height):
-            for img_x in range(trimmed_width):
-                idx = img_x + trim_left + width * (img_y + trim_bottom)
-                pixel_type = raw_data[idx]
-                x = img_x
-                y = trimmed_height - img_y - 1
-                if pixel_type == ImageHandlerRoborock.MAP_OUTSIDE:
-                    pixels[x, y] = ImageHandlerRoborock.__get_color__(COLOR_MAP_OUTSIDE, colors)
-                elif pixel_type == ImageHandlerRoborock.MAP_WALL:
-                    pixels[x, y] = ImageHandlerRoborock.__get_color__(COLOR_MAP_WALL, colors)
-                elif pixel_type == ImageHandlerRoborock.MAP_INSIDE:
-                    pixels[x, y] = ImageHandlerRoborock.__get_color__(COLOR_MAP_INSIDE, colors)
-                elif pixel_type == ImageHandlerRoborock.MAP_SCAN:
-                    pixels[x, y] = ImageHandlerRoborock.__get_color__(COLOR_SCAN, colors)
-                else:
-                    obstacle = pixel_type & 0x07
-                    if obstacle == 0:
-                        pixels[x, y] = ImageHandlerRoborock.__get_color__(COLOR_GREY_WALL, colors)
-                    elif obstacle == 1:
-                        pixels[x, y] = ImageHandlerRoborock.__get_color__(COLOR_MAP_WALL_V2, colors)
-                    elif obstacle == 7:
-                        room_number = (pixel_type & 0xFF) >> 3
-                        room_x = img_x + trim_left
-                        room_y = img_y + trim_bottom
-                        if room_number not in rooms:
-                            rooms[room_number] = (room_x, room_y, room_x, room_y)
-                        else:
-                            rooms[room_number] = (min(rooms[room_number][0], room_x),
-                                                  min(rooms[room_number][1], room_y),
-                                                  max(rooms[room_number][2], room_x),
-                                                  max(rooms[room_number][3], room_y))
-                        default = ImageHandlerRoborock.ROOM_COLORS[room_number >> 1]
-                        pixels[x, y] = ImageHandlerRoborock.__get_color__(f"{COLOR_ROOM_PREFIX}{room_number}", colors,
-                                                                          default)
-                    else:
-                        pixels[x, y] = ImageHandlerRoborock.__get_color__(COLOR_UNKNOWN, colors)
-
-                if idx in carpet_map and (x + y) % 2:
-                    def combine_color_component(base: int, overlay: int, alpha: int):
-                        return int((base * (255 - alpha) + overlay * alpha) / 255)
-
-                    carpet_color = ImageHandlerRoborock.__get_color__(COLOR_CARPETS, colors)
-
-                    if not pixels[x, y] or len(carpet_color) != 4:
-                        pixels[x, y] = carpet_color
-                    else:
-                        pixels[x, y] = (combine_color_component(pixels[x, y][0], carpet_color[0], carpet_color[3]),
-                            combine_color_component(pixels[x, y][1], carpet_color[1], carpet_color[3]),
-                            combine_color_component(pixels[x, y][2], carpet_color[2], carpet_color[3]))
-
-        if image_config["scale"] != 1 and width != 0 and height != 0:
+            return {}
+        pixels, trim_left, trim_bottom = ImageHandlerRoborock.__get_trimmed_pixels__(raw_data, width, height,
+                                                                                    image_config)
+        return ImageHandlerRoborock.__get_room_bounds__(pixels, trim_left, trim_bottom)
+
+    @staticmethod
+    def draw_map(raw_data: bytes, width: int, height: int, carpet_map: Optional[CarpetMap], colors: Colors,
+                 image_config: ImageConfig) -> ImageType:
+        if width == 0 or height == 0:
+            return ImageHandlerRoborock.create_empty_map_image(colors)
+        scale = image_config[CONF_SCALE]
+        pixels, trim_left, trim_bottom = ImageHandlerRoborock.__get_trimmed_pixels__(raw_data, width, height,
+                                                                                    image_config)
+        trimmed_height, trimmed_width = pixels.shape
+        # the map is stored bottom-up, the image is drawn top-down
+        pixels = pixels[::-1]
+        lut = ImageHandlerRoborock.__get_lut__(colors)
+        # the map is a palette image of the pixel types that are present
+        used = np.bincount(pixels.ravel(), minlength=256) > 0
+        palette = lut[used]
+        palette_indexes = np.zeros(256, dtype=np.uint16)
+        palette_indexes[used] = np.arange(len(palette))
+        indexes = palette_indexes[pixels]
+
+        if carpet_map:
+            mask = carpet_map.mask()[:width * height]
+            carpet = np.zeros(width * height, dtype=bool)
+            carpet[:len(mask)] = mask
+            carpet = carpet.reshape(height, width)[trim_bottom:trim_bottom + trimmed_height,
+                                                   trim_left:trim_left + trimmed_width][::-1]
+            y, x = np.indices(carpet.shape)
+            carpet &= ((x + y) % 2).astype(bool)
+            # carpets get palette entries of their own for every pixel type they cover
+            carpet_pixels = pixels[carpet]
+            carpet_used = np.bincount(carpet_pixels, minlength=256) > 0
+            carpet_palette = ImageHandlerRoborock.__blend_carpet__(lut[carpet_used], colors)
+            palette_indexes[carpet_used] = np.arange(len(carpet_palette)) + len(palette)
+            indexes[carpet] = palette_indexes[carpet_pixels]
+            palette = np.concatenate((palette, carpet_palette))
+
+        if len(palette) <= 256:
+            image = Image.fromarray(indexes.astype(np.uint8), "P")
+            image.putpalette(palette.tobytes(), "RGBA")
+        else:
+            image = Image.fromarray(palette[indexes], "RGBA")
+        if scale != 1:
             image = image.resize((int(trimmed_width * scale), int(trimmed_height * scale)), resample=Image.NEAREST)
-        return image, rooms
+        # the map is scaled before it is rotated, nearest neighbour scaling does not pick
+        # the same source pixels once the sides are reversed, and the overlays follow this order
+        rotation = image_config[CONF_ROTATE]
+        if rotation in ImageHandlerRoborock.ROTATIONS:
+            image = image.transpose(ImageHandlerRoborock.ROTATIONS[rotation])
+        return image
+
+    @staticmethod
+    def __blend_carpet__(palette: np.ndarray, colors: Colors) -> np.ndarray:
+        carpet_color = ImageHandlerRoborock.__get_color__(COLOR_CARPETS, colors)
+        if len(carpet_color) != 4:
+            return np.tile(np.array((*carpet_color, 255), dtype=np.uint8), (len(palette), 1))
+        alpha = carpet_color[3]
+        base = palette[:, :3].astype(np.uint32)
+        blended = (base * (255 - alpha) + np.array(carpet_color[:3], dtype=np.uint32) * alpha) // 255
+        return np.concatenate((blended, np.full((len(blended), 1), 255, dtype=np.uint32)), axis=1).astype(np.uint8)
+
+    @staticmethod
+    def to_palette(image: ImageData):
+        # images with few colors are kept as palette images, they take a quarter of the memory and encode faster
+        if image.data.mode != "RGBA":
+            return
+        image_colors = image.data.getcolors(256)
+        if image_colors is None:
+            return
+        palette = np.array([color for _, color in image_colors], dtype=np.uint8)
+        keys = palette.view(np.uint32).ravel()
+        order = np.argsort(keys)
+        pixels = np.asarray(image.data).view(np.uint32)[:, :, 0]
+        indexes = order[np.searchsorted(keys[order], pixels)].astype(np.uint8)
+        image.data = Image.fromarray(indexes, "P")
+        image.data.putpalette(palette.tobytes(), "RGBA")
 
     @staticmethod
     def get_room_at_pixel(raw_data: bytes, width: int, x: int, y: int) -> int:
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 from collections.abc import Callable
 
+import numpy as np
 from PIL.Image import Image as ImageType
 
 from custom_components.roborock.common.types import (
@@ -13,6 +14,8 @@ from custom_components.roborock.const import *
 
 
 class Point:
+    __slots__ = ("x", "y", "a")
+
     def __init__(self, x: float, y: float, a=None):
         self.x = x
         self.y = y
@@ -43,20 +46,15 @@ class Point:
         return image_dimensions.to_img(self)
 
     def rotated(self, image_dimensions) -> Point:
-        alpha = image_dimensions.rotation
         w = int(image_dimensions.width * image_dimensions.scale)
         h = int(image_dimensions.height * image_dimensions.scale)
-        x = self.x
-        y = self.y
-        while alpha > 0:
-            tmp = y
-            y = w - x
-            x = tmp
-            tmp = h
-            h = w
-            w = tmp
-            alpha = alpha - 90
-        return Point(x, y)
+        if image_dimensions.rotation == 90:
+            return Point(self.y, w - self.x)
+        if image_dimensions.rotation == 180:
+            return Point(w - self.x, h - self.y)
+        if image_dimensions.rotation == 270:
+            return Point(h - self.y, self.x)
+        return Point(self.x, self.y)
 
     def __mul__(self, other) -> Point:
         return Point(self.x * other, self.y * other, self.a)
@@ -66,9 +64,23 @@ class Point:
 
 
 class Obstacle(Point):
-    def __init__(self, x: float, y: float, details: Dict[str, Any]):
+    __slots__ = ("_details", "_record", "_decode_details")
+
+    def __init__(self, x: float, y: float, details: Optional[Dict[str, Any]] = None, record: Tuple = (),
+                 decode_details: Optional[Callable[[Tuple], Dict[str, Any]]] = None):
         super().__init__(x, y)
-        self.details = details
+        self._details = details
+        self._record = record
+        self._decode_details = decode_details
+
+    @property
+    def details(self) -> Dict[str, Any]:
+        # the details of a parsed obstacle are only decoded from its record when they are needed
+        if self._details is None:
+            self._details = {} if self._decode_details is None else self._decode_details(self._record)
+            self._record = ()
+            self._decode_details = None
+        return self._details
 
     def as_dict(self) -> Dict[str, Any]:
         return {**super().as_dict(), **self.details}
@@ -95,8 +107,35 @@ class ImageDimensions:
         self.scale = scale
         self.rotation = rotation
         self.img_transformation = img_transformation
+        # the image is drawn already rotated, so the rotation is a part of the transformation to the image:
+        # x' = xx * x + xy * y + x0, y' = yx * x + yy * y + y0
+        # pixel positions are mirrored exactly, fractional positions are rounded by Pillow after mirroring,
+        # so overlays at them can be one pixel off from a transposed unrotated image
+        w = int(width * scale)
+        h = int(height * scale)
+        x0 = -left * scale
+        y0 = (height + top - 1) * scale
+        if rotation == 90:
+            self.affine = (0, -scale, y0, -scale, 0, w - 1 - x0)
+        elif rotation == 180:
+            self.affine = (-scale, 0, w - 1 - x0, 0, scale, h - 1 - y0)
+        elif rotation == 270:
+            self.affine = (0, scale, h - 1 - y0, scale, 0, x0)
+        else:
+            self.affine = (scale, 0, x0, 0, -scale, y0)
 
     def to_img(self, point: Point) -> Point:
+        p = self.img_transformation(point)
+        xx, xy, x0, yx, yy, y0 = self.affine
+        return Point(xx * p.x + xy * p.y + x0, yx * p.x + yy * p.y + y0)
+
+    def to_img_array(self, points: np.ndarray) -> np.ndarray:
+        # points is an (n, 2) array of x, y, the transformation gets all of them at once as arrays
+        p = self.img_transformation(Point(points[:, 0], points[:, 1]))
+        xx, xy, x0, yx, yy, y0 = self.affine
+        return np.stack((xx * p.x + xy * p.y + x0, yx * p.x + yy * p.y + y0), axis=1)
+
+    def to_unrotated_img(self, point: Point) -> Point:
         p = self.img_transformation(point)
         return Point(
             (p.x - self.left) * self.scale,
@@ -116,6 +155,7 @@ class ImageData:
             data: ImageType,
             img_transformation: Callable[[Point], Point],
             additional_layers: dict = None,
+            raster: Optional[bytes] = None,
     ):
         trim_left = int(image_config[CONF_TRIM][CONF_LEFT] * width / 100)
         trim_right = int(image_config[CONF_TRIM][CONF_RIGHT] * width / 100)
@@ -135,6 +175,10 @@ class ImageData:
         )
         self.is_empty = height == 0 or width == 0
         self.data = data
+        self.raster = raster
+        self.base_digest: Optional[bytes] = None
+        self.raster_width = width
+        self.raster_height = height
         if additional_layers is None:
             self.additional_layers = {}
         else:
@@ -163,14 +207,53 @@ class ImageData:
         return ImageData(0, 0, 0, 0, 0, image_config, data, lambda p: p)
 
 
+class CarpetMap:
+    def __init__(self, mask: np.ndarray):
+        # carpet pixels of the image block, packed to one bit per pixel
+        self.size = len(mask)
+        self.bits = np.packbits(mask)
+        self._count = int(np.count_nonzero(mask))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, index: int) -> bool:
+        return 0 <= index < self.size and bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.mask()).tolist())
+
+    def mask(self) -> np.ndarray:
+        return np.unpackbits(self.bits, count=self.size).view(bool)
+
+    def runs(self) -> List[List[int]]:
+        # [index, length] of every run of consecutive carpet pixels
+        edges = np.diff(np.concatenate(([0], self.mask().view(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        return np.stack((starts, ends - starts), axis=1).tolist()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {ATTR_SIZE: self.size, ATTR_RUNS: self.runs()}
+
+    def __str__(self) -> str:
+        return f"CarpetMap(size = {self.size}, pixels = {self._count})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
 class Path:
+    __slots__ = ("point_length", "point_size", "angle", "path")
+
     def __init__(
             self,
             point_length: Optional[int],
             point_size: Optional[int],
             angle: Optional[int],
-            path: List[List[Point]],
+            path: List[np.ndarray],
     ):
+        # every sub path is an (n, 2) array of x, y, as stored in the map
         self.point_length = point_length
         self.point_size = point_size
         self.angle = angle
@@ -181,11 +264,13 @@ class Path:
             ATTR_POINT_LENGTH: self.point_length,
             ATTR_POINT_SIZE: self.point_size,
             ATTR_ANGLE: self.angle,
-            ATTR_PATH: self.path,
+            ATTR_PATH: [[{ATTR_X: x, ATTR_Y: y} for x, y in sub_path.tolist()] for sub_path in self.path],
         }
 
 
 class Zone:
+    __slots__ = ("x0", "y0", "x1", "y1")
+
     def __init__(self, x0: float, y0: float, x1: float, y1: float):
         self.x0 = x0
         self.y0 = y0
@@ -208,6 +293,8 @@ class Zone:
 
 
 class Room(Zone):
+    __slots__ = ("number", "name", "pos_x", "pos_y")
+
     def __init__(
             self,
             number: int,
@@ -248,6 +335,8 @@ class Room(Zone):
 
 
 class Wall:
+    __slots__ = ("x0", "y0", "x1", "y1")
+
     def __init__(self, x0: float, y0: float, x1: float, y1: float):
         self.x0 = x0
         self.y0 = y0
@@ -273,6 +362,8 @@ class Wall:
 
 
 class Area:
+    __slots__ = ("x0", "y0", "x1", "y1", "x2", "y2", "x3", "y3")
+
     def __init__(
             self,
             x0: float,
@@ -334,7 +425,7 @@ class MapData:
         self.no_go_areas: Optional[List[Area]] = None
         self.no_mopping_areas: Optional[List[Area]] = None
         self.no_carpet_areas: Optional[List[Area]] = None
-        self.carpet_map: Optional[Set[int]] = []
+        self.carpet_map: Optional[CarpetMap] = None
         self.obstacles: Optional[List[Obstacle]] = None
         self.ignored_obstacles: Optional[List[Obstacle]] = None
         self.obstacles_with_photo: Optional[List[Obstacle]] = None
@@ -350,6 +441,20 @@ class MapData:
         self.zones: Optional[List[Zone]] = None
         self.cleaned_rooms: Optional[Set[int]] = None
         self.map_name: Optional[str] = None
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+
+    def set_lazy(self, name: str, loader: Callable[[], Any]) -> None:
+        # the attribute is resolved by __getattr__ on first access
+        self.__dict__.pop(name, None)
+        self._loaders[name] = loader
+
+    def __getattr__(self, name: str) -> Any:
+        loaders = self.__dict__.get("_loaders")
+        if not loaders or name not in loaders:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        value = loaders.pop(name)()
+        setattr(self, name, value)
+        return value
 
     def calibration(self) -> Optional[CalibrationPoints]:
         if self.image.is_empty:
@@ -366,7 +471,7 @@ class MapData:
                 self._calibration_center + self._calibration_diff,
             ),
         ]:
-            img_point = point.to_img(self.image.dimensions).rotated(
+            img_point = self.image.dimensions.to_unrotated_img(point).rotated(
                 self.image.dimensions
             )
             calibration_points.append(
@@ -1,12 +1,41 @@
+import hashlib
 import logging
+import struct
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
 from typing import Tuple
 
-from custom_components.roborock.common.image_handler import ImageHandlerRoborock
+import numpy as np
+
+from custom_components.roborock.common.image_handler import DynamicPart, ImageHandlerRoborock
 from custom_components.roborock.common.map_data import *
 from custom_components.roborock.common.types import Colors, Drawables, Sizes, Texts
 
 _LOGGER = logging.getLogger(__name__)
 
+# (block start position, block header length, block data length)
+BlockIndex = Tuple[int, int, int]
+
+_INT16 = struct.Struct("<H")
+_INT32 = struct.Struct("<I")
+_MAP_HEADER = struct.Struct("<2xH4xHHII")
+_BLOCK_HEADER = struct.Struct("<HHI")
+_IMAGE_HEADER = struct.Struct("<IIII")
+_PATH_HEADER = struct.Struct("<4xIIII")
+_OBJECT_POSITION = struct.Struct("<II")
+_POINT = struct.Struct("<HH")
+_PATH_POINT = np.dtype("<u2")
+_WALL = struct.Struct("<4H")
+_AREA = struct.Struct("<8H")
+# obstacle records by their size: x, y, type, confidence and photo name, as far as the robot reports them
+_OBSTACLE_RECORDS = {
+    4: struct.Struct("<HH"),
+    6: struct.Struct("<HHH"),
+    10: struct.Struct("<HHHHH"),
+    28: struct.Struct("<HHHHH2x16s"),
+}
+
 
 class MapDataParserRoborock:
     CHARGER = 1
@@ -38,6 +67,49 @@ class MapDataParserRoborock:
         9: "weighting scale",
         10: "clothes"
     }
+    BLOCK_ATTRIBUTES = {
+        CHARGER: "charger",
+        ROBOT_POSITION: "vacuum_position",
+        PATH: "path",
+        GOTO_PATH: "goto_path",
+        GOTO_PREDICTED_PATH: "predicted_path",
+        CURRENTLY_CLEANED_ZONES: "zones",
+        GOTO_TARGET: "goto",
+        VIRTUAL_WALLS: "walls",
+        NO_GO_AREAS: "no_go_areas",
+        NO_MOPPING_AREAS: "no_mopping_areas",
+        OBSTACLES: "obstacles",
+        IGNORED_OBSTACLES: "ignored_obstacles",
+        OBSTACLES_WITH_PHOTO: "obstacles_with_photo",
+        IGNORED_OBSTACLES_WITH_PHOTO: "ignored_obstacles_with_photo",
+        BLOCKS: "blocks",
+        MOP_PATH: "mop_path",
+        CARPET_MAP: "carpet_map",
+        NO_CARPET_AREAS: "no_carpet_areas",
+    }
+    # drawn on every frame, all other drawables are part of the cached base layer,
+    # mapped to the attribute they are drawn from and the size of their elements
+    DYNAMIC_DRAWABLES = {
+        DRAWABLE_VACUUM_POSITION: ("vacuum_position", CONF_SIZE_VACUUM_RADIUS),
+        DRAWABLE_PATH: ("path", CONF_SIZE_PATH_WIDTH),
+        DRAWABLE_GOTO_PATH: ("goto_path", CONF_SIZE_PATH_WIDTH),
+        DRAWABLE_PREDICTED_PATH: ("predicted_path", CONF_SIZE_PATH_WIDTH),
+        DRAWABLE_MOP_PATH: ("mop_path", CONF_SIZE_MOP_PATH_WIDTH),
+        DRAWABLE_OBSTACLES: ("obstacles", CONF_SIZE_OBSTACLE_RADIUS),
+        DRAWABLE_IGNORED_OBSTACLES: ("ignored_obstacles", CONF_SIZE_IGNORED_OBSTACLE_RADIUS),
+        DRAWABLE_OBSTACLES_WITH_PHOTO: ("obstacles_with_photo", CONF_SIZE_OBSTACLE_WITH_PHOTO_RADIUS),
+        DRAWABLE_IGNORED_OBSTACLES_WITH_PHOTO: ("ignored_obstacles_with_photo",
+                                                CONF_SIZE_IGNORED_OBSTACLE_WITH_PHOTO_RADIUS),
+    }
+    # paths are compared between frames in chunks of this many segments
+    PATH_CHUNK_SIZE = 128
+    # by (device id, drawable): (map index and transformation the parts are for, lengths of the finished sub paths,
+    # parts, complete chunks of the last sub path, (sub path, start, end) of the last cached chunk)
+    _path_parts_cache: Dict[Tuple[str, str], Tuple[tuple, List[int], List[DynamicPart], int,
+                                                   Optional[Tuple[int, int, int]]]] = {}
+    # blocks the base layer is drawn from
+    STATIC_BLOCKS = [CHARGER, IMAGE, CURRENTLY_CLEANED_ZONES, NO_GO_AREAS, VIRTUAL_WALLS, NO_MOPPING_AREAS,
+                     CARPET_MAP, NO_CARPET_AREAS]
 
     @staticmethod
     def create_empty(colors: Colors, text: str) -> MapData:
@@ -87,93 +159,209 @@ class MapDataParserRoborock:
             if drawable == DRAWABLE_ROOM_NAMES and map_data.rooms is not None:
                 ImageHandlerRoborock.draw_room_names(map_data.image, map_data.rooms, colors)
 
+    @staticmethod
+    def parse_map_header(raw: bytes) -> Tuple[int, int]:
+        _, _, _, map_index, map_sequence = _MAP_HEADER.unpack_from(raw)
+        return map_index, map_sequence
+
+    @staticmethod
+    def get_block(raw: memoryview, block: BlockIndex) -> Tuple[memoryview, memoryview]:
+        block_start_position, block_header_length, block_data_length = block
+        block_data_start = block_start_position + block_header_length
+        return raw[block_start_position:block_data_start], raw[block_data_start:block_data_start + block_data_length]
+
+    @staticmethod
+    def decode_block(block_type: int, raw: memoryview, block: BlockIndex, map_data: MapData,
+                     image_config: ImageConfig) -> Any:
+        block_start_position, _, block_data_length = block
+        header, data = MapDataParserRoborock.get_block(raw, block)
+        if block_type in (MapDataParserRoborock.CHARGER, MapDataParserRoborock.ROBOT_POSITION):
+            return MapDataParserRoborock.parse_object_position(block_data_length, data)
+        if block_type in (MapDataParserRoborock.PATH, MapDataParserRoborock.GOTO_PATH,
+                          MapDataParserRoborock.GOTO_PREDICTED_PATH):
+            return MapDataParserRoborock.parse_path(block_start_position, header, raw)
+        if block_type == MapDataParserRoborock.CURRENTLY_CLEANED_ZONES:
+            return MapDataParserRoborock.parse_zones(data, header)
+        if block_type == MapDataParserRoborock.GOTO_TARGET:
+            return MapDataParserRoborock.parse_goto_target(data)
+        if block_type == MapDataParserRoborock.VIRTUAL_WALLS:
+            return MapDataParserRoborock.parse_walls(data, header)
+        if block_type in (MapDataParserRoborock.NO_GO_AREAS, MapDataParserRoborock.NO_MOPPING_AREAS,
+                          MapDataParserRoborock.NO_CARPET_AREAS):
+            return MapDataParserRoborock.parse_area(header, data)
+        if block_type in (MapDataParserRoborock.OBSTACLES, MapDataParserRoborock.IGNORED_OBSTACLES,
+                          MapDataParserRoborock.OBSTACLES_WITH_PHOTO,
+                          MapDataParserRoborock.IGNORED_OBSTACLES_WITH_PHOTO):
+            return MapDataParserRoborock.parse_obstacles(data, header)
+        if block_type == MapDataParserRoborock.BLOCKS:
+            block_pairs = MapDataParserRoborock.get_int16(header, 0x08)
+            return bytes(data[:block_pairs])
+        if block_type == MapDataParserRoborock.MOP_PATH:
+            if map_data.path is None:
+                return None
+            # only the map_data.path points where points_mask == 1 are in mop_path
+            return MapDataParserRoborock.parse_mop_path(map_data.path, data)
+        if block_type == MapDataParserRoborock.CARPET_MAP:
+            # only the indexes where value == 1 are in carpet_map
+            return MapDataParserRoborock.parse_carpet_map(data, image_config)
+        return None
+
     @staticmethod
     def parse(raw: bytes, colors: Colors, drawables: Drawables, texts: Texts, sizes: Sizes,
               image_config: ImageConfig, *args, **kwargs) -> MapData:
-        map_data = MapData(25500, 1000)
-        map_header_length = MapDataParserRoborock.get_int16(raw, 0x02)
-        map_data.major_version = MapDataParserRoborock.get_int16(raw, 0x08)
-        map_data.minor_version = MapDataParserRoborock.get_int16(raw, 0x0A)
-        map_data.map_index = MapDataParserRoborock.get_int32(raw, 0x0C)
-        map_data.map_sequence = MapDataParserRoborock.get_int32(raw, 0x10)
-        block_start_position = map_header_length
-        img_start = None
-        img_data = None
-        while block_start_position < len(raw):
-            block_header_length = MapDataParserRoborock.get_int16(raw, block_start_position + 0x02)
-            header = MapDataParserRoborock.get_bytes(raw, block_start_position, block_header_length)
-            block_type = MapDataParserRoborock.get_int16(header, 0x00)
-            block_data_length = MapDataParserRoborock.get_int32(header, 0x04)
-            block_data_start = block_start_position + block_header_length
-            data = MapDataParserRoborock.get_bytes(raw, block_data_start, block_data_length)
-
-            if block_type == MapDataParserRoborock.CHARGER:
-                map_data.charger = MapDataParserRoborock.parse_object_position(block_data_length, data)
-            elif block_type == MapDataParserRoborock.IMAGE:
-                img_start = block_start_position
-                img_data_length = block_data_length
-                img_header_length = block_header_length
-                img_data = data
-                img_header = header
-            elif block_type == MapDataParserRoborock.ROBOT_POSITION:
-                map_data.vacuum_position = MapDataParserRoborock.parse_object_position(block_data_length, data)
-            elif block_type == MapDataParserRoborock.PATH:
-                map_data.path = MapDataParserRoborock.parse_path(block_start_position, header, raw)
-            elif block_type == MapDataParserRoborock.GOTO_PATH:
-                map_data.goto_path = MapDataParserRoborock.parse_path(block_start_position, header, raw)
-            elif block_type == MapDataParserRoborock.GOTO_PREDICTED_PATH:
-                map_data.predicted_path = MapDataParserRoborock.parse_path(block_start_position, header, raw)
-            elif block_type == MapDataParserRoborock.CURRENTLY_CLEANED_ZONES:
-                map_data.zones = MapDataParserRoborock.parse_zones(data, header)
-            elif block_type == MapDataParserRoborock.GOTO_TARGET:
-                map_data.goto = MapDataParserRoborock.parse_goto_target(data)
-            elif block_type == MapDataParserRoborock.DIGEST:
-                map_data.is_valid = True
-            elif block_type == MapDataParserRoborock.VIRTUAL_WALLS:
-                map_data.walls = MapDataParserRoborock.parse_walls(data, header)
-            elif block_type == MapDataParserRoborock.NO_GO_AREAS and image_config[CONF_INCLUDE_NOGO]:
-                map_data.no_go_areas = MapDataParserRoborock.parse_area(header, data)
-            elif block_type == MapDataParserRoborock.NO_MOPPING_AREAS:
-                map_data.no_mopping_areas = MapDataParserRoborock.parse_area(header, data)
-            elif block_type == MapDataParserRoborock.OBSTACLES:
-                map_data.obstacles = MapDataParserRoborock.parse_obstacles(data, header)
-            elif block_type == MapDataParserRoborock.IGNORED_OBSTACLES and image_config[CONF_INCLUDE_IGNORED_OBSTACLES]:
-                map_data.ignored_obstacles = MapDataParserRoborock.parse_obstacles(data, header)
-            elif block_type == MapDataParserRoborock.OBSTACLES_WITH_PHOTO:
-                map_data.obstacles_with_photo = MapDataParserRoborock.parse_obstacles(data, header)
-            elif block_type == MapDataParserRoborock.IGNORED_OBSTACLES_WITH_PHOTO:
-                map_data.ignored_obstacles_with_photo = MapDataParserRoborock.parse_obstacles(data, header)
-            elif block_type == MapDataParserRoborock.BLOCKS:
-                block_pairs = MapDataParserRoborock.get_int16(header, 0x08)
-                map_data.blocks = MapDataParserRoborock.get_bytes(data, 0, block_pairs)
-            elif block_type == MapDataParserRoborock.MOP_PATH:
-                points_mask = MapDataParserRoborock.get_bytes(raw, block_data_start, block_data_length)
-                # only the map_data.path points where points_mask == 1 are in mop_path
-                map_data.mop_path = MapDataParserRoborock.parse_mop_path(map_data.path, points_mask)
-            elif block_type == MapDataParserRoborock.CARPET_MAP:
-                data = MapDataParserRoborock.get_bytes(raw, block_data_start, block_data_length)
-                # only the indexes where value == 1 are in carpet_map
-                map_data.carpet_map = MapDataParserRoborock.parse_carpet_map(data, image_config)
-            elif block_type == MapDataParserRoborock.NO_CARPET_AREAS:
-                map_data.no_carpet_areas = MapDataParserRoborock.parse_area(header, data)
+        map_data = MapDataParserRoborock.parse_model(raw, image_config)
+        MapDataParserRoborock.render(map_data, colors, drawables, texts, sizes, image_config)
+        return map_data
+
+    @staticmethod
+    def parse_model(raw: bytes, image_config: ImageConfig) -> MapData:
+        # a whole payload is a stream of one chunk, its blocks are used in place
+        parser = MapDataStreamParser(image_config)
+        parser.feed(raw)
+        return parser.finish()
+
+    @staticmethod
+    def add_block(map_data: MapData, block_type: int, raw: memoryview, block: BlockIndex,
+                  image_config: ImageConfig) -> None:
+        _, block_header_length, block_data_length = block
+        if block_type not in MapDataParserRoborock.BLOCK_ATTRIBUTES and block_type not in (
+                MapDataParserRoborock.IMAGE, MapDataParserRoborock.DIGEST):
+            _LOGGER.debug("UNKNOWN BLOCK TYPE: %s, header length %s, data length %s", block_type, block_header_length, block_data_length)
+        if block_type == MapDataParserRoborock.DIGEST:
+            map_data.is_valid = True
+        if block_type == MapDataParserRoborock.NO_GO_AREAS and not image_config[CONF_INCLUDE_NOGO]:
+            return
+        if block_type == MapDataParserRoborock.IGNORED_OBSTACLES and not image_config[CONF_INCLUDE_IGNORED_OBSTACLES]:
+            return
+        attribute = MapDataParserRoborock.BLOCK_ATTRIBUTES.get(block_type)
+        if attribute is not None:
+            # blocks are only decoded when the attribute is first read from map_data
+            map_data.set_lazy(attribute, partial(MapDataParserRoborock.decode_block, block_type, raw, block,
+                                                 map_data, image_config))
+        if block_type == MapDataParserRoborock.IMAGE and block_data_length > 0:
+            img_header, img_data = MapDataParserRoborock.get_block(raw, block)
+            map_data.image, map_data.rooms = MapDataParserRoborock.parse_image(block_data_length, block_header_length,
+                                                                               img_data, img_header, image_config)
+
+    @staticmethod
+    def get_dynamic_parts(map_data: MapData, drawables: Drawables, sizes: Sizes,
+                          device_id: Optional[str] = None) -> List[DynamicPart]:
+        parts = []
+        for drawable in drawables:
+            attribute, size = MapDataParserRoborock.DYNAMIC_DRAWABLES[drawable]
+            value = getattr(map_data, attribute)
+            if value is None:
+                continue
+            if isinstance(value, Path):
+                parts.extend(MapDataParserRoborock.get_path_parts(map_data, device_id, drawable, value, sizes[size] / 2))
+            elif isinstance(value, list):
+                for point in value:
+                    parts.append((drawable, point, hash((point.x, point.y)),
+                                  ImageHandlerRoborock.get_bounds(map_data.image, [point], sizes[size])))
             else:
-                _LOGGER.debug("UNKNOWN BLOCK TYPE: %s, header length %s, data length %s", block_type, block_header_length, block_data_length)
-            block_start_position = block_start_position + block_data_length + MapDataParserRoborock.get_int8(header, 2)
+                parts.append((drawable, value, hash((value.x, value.y, value.a)),
+                              ImageHandlerRoborock.get_bounds(map_data.image, [value], sizes[size])))
+        return parts
 
-        if img_data:
-            image, rooms = MapDataParserRoborock.parse_image(img_data_length, img_header_length, img_data, img_header, map_data.carpet_map,
-                                                           colors, image_config)
-            map_data.image = image
-            map_data.rooms = rooms
+    @staticmethod
+    def get_path_parts(map_data: MapData, device_id: Optional[str], drawable: str, path: Path,
+                       padding: float) -> List[DynamicPart]:
+        # during a run the path only grows, the parts of the previous frame of the same device and map are kept
+        # as long as the path still starts with them, only the points appended since are split into chunks
+        chunk_size = MapDataParserRoborock.PATH_CHUNK_SIZE
+        cache = MapDataParserRoborock._path_parts_cache
+        image = map_data.image
+        sub_paths = path.path
+        key = (device_id, drawable)
+        signature = (map_data.map_index, image.dimensions.affine, padding)
+        cached_signature, lengths, parts, chunks, last = cache.get(key, (None, [], [], 0, None))
+        finished = len(lengths)
+        # the path still starts with the cached parts if the finished sub paths kept their lengths
+        # and the last cached chunk is unchanged
+        if device_id is None or cached_signature != signature or finished >= len(sub_paths) \
+                or len(sub_paths[finished]) < (chunks * chunk_size + 1 if chunks > 0 else 0) \
+                or [len(sub_path) for sub_path in sub_paths[:finished]] != lengths \
+                or (last is not None and hash(sub_paths[last[0]][last[1]:last[2]].tobytes()) != parts[-1][2]):
+            lengths, parts, chunks, finished, last = [], [], 0, 0, None
+        # a new list, the cached one is only replaced once the parts of this frame are complete
+        parts = list(parts)
+        tail = []
+        for index in range(finished, len(sub_paths)):
+            sub_path = sub_paths[index]
+            # consecutive chunks share a point, so that they join up
+            for start in range((chunks if index == finished else 0) * chunk_size, len(sub_path) - 1, chunk_size):
+                # a copy, cached chunks must not keep the raw map of their frame alive
+                chunk = sub_path[start:start + chunk_size + 1].copy()
+                corners = [Point(*chunk.min(axis=0).tolist()), Point(*chunk.max(axis=0).tolist())]
+                part = (drawable, chunk, hash(chunk.tobytes()),
+                        ImageHandlerRoborock.get_bounds(image, corners, padding))
+                if index == len(sub_paths) - 1 and len(chunk) <= chunk_size:
+                    tail.append(part)
+                else:
+                    parts.append(part)
+                    last = (index, start, start + len(chunk))
+        if device_id is not None and len(sub_paths) > 0:
+            chunks = max((len(sub_paths[-1]) - 1) // chunk_size, 0)
+            lengths = lengths + [len(sub_path) for sub_path in sub_paths[finished:-1]]
+            cache[key] = (signature, lengths, parts, chunks, last)
+        return parts + tail
 
-        if map_data.image and not map_data.image.is_empty:
-            MapDataParserRoborock.draw_elements(colors, drawables, sizes, map_data, image_config)
-            if len(map_data.rooms) > 0 and map_data.vacuum_position is not None:
-                map_data.vacuum_room = MapDataParserRoborock.get_current_vacuum_room(img_start, raw,
-                                                                                     map_data.vacuum_position)
-            ImageHandlerRoborock.rotate(map_data.image)
-            ImageHandlerRoborock.draw_texts(map_data.image, texts)
-        return map_data
+    @staticmethod
+    def draw_dynamic_parts(colors: Colors, drawables: Drawables, sizes: Sizes, image_config: ImageConfig,
+                           image: ImageData, parts: List[DynamicPart]):
+        elements = MapData()
+        elements.image = image
+        for drawable, group in groupby(parts, key=itemgetter(0)):
+            attribute, _ = MapDataParserRoborock.DYNAMIC_DRAWABLES[drawable]
+            values = [part[1] for part in group]
+            if drawable == DRAWABLE_VACUUM_POSITION:
+                setattr(elements, attribute, values[0])
+            elif isinstance(values[0], np.ndarray):
+                setattr(elements, attribute, Path(None, None, None, values))
+            else:
+                setattr(elements, attribute, values)
+        MapDataParserRoborock.draw_elements(colors, drawables, sizes, elements, image_config)
+
+    @staticmethod
+    def get_base_digest(blocks: Dict[int, Tuple[memoryview, BlockIndex]]) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        for block_type in MapDataParserRoborock.STATIC_BLOCKS:
+            if block_type in blocks:
+                raw, (start, header_length, data_length) = blocks[block_type]
+                digest.update(_INT16.pack(block_type))
+                digest.update(raw[start:start + header_length + data_length])
+        return digest.digest()
+
+    @staticmethod
+    def render(map_data: MapData, colors: Colors, drawables: Drawables, texts: Texts, sizes: Sizes,
+               image_config: ImageConfig, device_id: Optional[str] = None) -> None:
+        image = map_data.image
+        if image is None or image.raster is None:
+            return
+        if image.is_empty:
+            image.data = ImageHandlerRoborock.draw_map(image.raster, image.raster_width, image.raster_height,
+                                                       map_data.carpet_map, colors, image_config)
+            return
+        static_drawables = [d for d in drawables if d not in MapDataParserRoborock.DYNAMIC_DRAWABLES]
+        render_key = ImageHandlerRoborock.get_render_key(colors, static_drawables, sizes, image_config)
+        base_key = (image.base_digest, render_key)
+        base = ImageHandlerRoborock.get_base_layer(base_key)
+        if base is None:
+            image.data = ImageHandlerRoborock.draw_map(image.raster, image.raster_width, image.raster_height,
+                                                       map_data.carpet_map, colors, image_config)
+            MapDataParserRoborock.draw_elements(colors, static_drawables, sizes, map_data, image_config)
+            ImageHandlerRoborock.set_base_layer(base_key, image.data)
+        else:
+            image.data = base
+        # only the elements that move during cleaning are drawn on every frame, always above the base layer,
+        # and only on the tiles where they or the base layer changed since the previous frame of the vacuum
+        dynamic_drawables = [d for d in drawables if d in MapDataParserRoborock.DYNAMIC_DRAWABLES]
+        parts = MapDataParserRoborock.get_dynamic_parts(map_data, dynamic_drawables, sizes, device_id)
+        ImageHandlerRoborock.draw_on_tiles(image, (render_key, tuple(dynamic_drawables), device_id), base_key, parts,
+                                           partial(MapDataParserRoborock.draw_dynamic_parts, colors,
+                                                   dynamic_drawables, sizes, image_config))
+        ImageHandlerRoborock.draw_texts(image, texts)
+        ImageHandlerRoborock.to_palette(image)
 
     @staticmethod
     def map_to_image(p: Point) -> Point:
@@ -184,28 +372,19 @@ class MapDataParserRoborock:
         return x * MM
 
     @staticmethod
-    def get_current_vacuum_room(block_start_position: int, raw: bytes, vacuum_position: Point) -> int:
-        block_header_length = MapDataParserRoborock.get_int16(raw, block_start_position + 0x02)
-        header = MapDataParserRoborock.get_bytes(raw, block_start_position, block_header_length)
-        block_data_length = MapDataParserRoborock.get_int32(header, 0x04)
-        block_data_start = block_start_position + block_header_length
-        data = MapDataParserRoborock.get_bytes(raw, block_data_start, block_data_length)
-        image_top = MapDataParserRoborock.get_int32(header, block_header_length - 16)
-        image_left = MapDataParserRoborock.get_int32(header, block_header_length - 12)
-        image_width = MapDataParserRoborock.get_int32(header, block_header_length - 4)
+    def get_current_vacuum_room(image_block: BlockIndex, raw: memoryview, vacuum_position: Point) -> int:
+        header, data = MapDataParserRoborock.get_block(raw, image_block)
+        image_top, image_left, _, image_width = _IMAGE_HEADER.unpack_from(header, image_block[1] - 16)
         p = MapDataParserRoborock.map_to_image(vacuum_position)
         room = ImageHandlerRoborock.get_room_at_pixel(data, image_width, round(p.x - image_left),
                                                       round(p.y - image_top))
         return room
 
     @staticmethod
-    def parse_image(block_data_length: int, block_header_length: int, data: bytes, header: bytes, carpet_map: Set[int],
-                    colors: Colors, image_config: ImageConfig) -> Tuple[ImageData, Dict[int, Room]]:
+    def parse_image(block_data_length: int, block_header_length: int, data: memoryview, header: memoryview,
+                    image_config: ImageConfig) -> Tuple[ImageData, Dict[int, Room]]:
         image_size = block_data_length
-        image_top = MapDataParserRoborock.get_int32(header, block_header_length - 16)
-        image_left = MapDataParserRoborock.get_int32(header, block_header_length - 12)
-        image_height = MapDataParserRoborock.get_int32(header, block_header_length - 8)
-        image_width = MapDataParserRoborock.get_int32(header, block_header_length - 4)
+        image_top, image_left, image_height, image_width = _IMAGE_HEADER.unpack_from(header, block_header_length - 16)
         if image_width \
                 - image_width * (image_config[CONF_TRIM][CONF_LEFT] + image_config[CONF_TRIM][CONF_RIGHT]) / 100 \
                 < MINIMAL_IMAGE_WIDTH:
@@ -216,7 +395,7 @@ class MapDataParserRoborock:
                 < MINIMAL_IMAGE_HEIGHT:
             image_config[CONF_TRIM][CONF_TOP] = 0
             image_config[CONF_TRIM][CONF_BOTTOM] = 0
-        image, rooms_raw = ImageHandlerRoborock.parse(data, image_width, image_height, carpet_map, colors, image_config)
+        rooms_raw = ImageHandlerRoborock.parse_rooms(data, image_width, image_height, image_config)
         rooms = {}
         for number, room in rooms_raw.items():
             rooms[number] = Room(number, MapDataParserRoborock.image_to_map(room[0] + image_left),
@@ -229,26 +408,20 @@ class MapDataParserRoborock:
                          image_height,
                          image_width,
                          image_config,
-                         image, MapDataParserRoborock.map_to_image), rooms
-    @staticmethod
-    def parse_carpet_map(data: bytes, image_config: ImageConfig) -> Set[int]:
-        carpet_map = set()
+                         None, MapDataParserRoborock.map_to_image, raster=data), rooms
 
-        for i, v in enumerate(data):
-            if v:
-                carpet_map.add(i)
-        return carpet_map
+    @staticmethod
+    def parse_carpet_map(data: memoryview, image_config: ImageConfig) -> CarpetMap:
+        return CarpetMap(np.frombuffer(data, dtype=np.uint8) != 0)
 
     @staticmethod
-    def parse_goto_target(data: bytes) -> Point:
-        x = MapDataParserRoborock.get_int16(data, 0x00)
-        y = MapDataParserRoborock.get_int16(data, 0x02)
+    def parse_goto_target(data: memoryview) -> Point:
+        x, y = _POINT.unpack_from(data)
         return Point(x, y)
 
     @staticmethod
-    def parse_object_position(block_data_length: int, data: bytes) -> Point:
-        x = MapDataParserRoborock.get_int32(data, 0x00)
-        y = MapDataParserRoborock.get_int32(data, 0x04)
+    def parse_object_position(block_data_length: int, data: memoryview) -> Point:
+        x, y = _OBJECT_POSITION.unpack_from(data)
         a = None
         if block_data_length > 8:
             a = MapDataParserRoborock.get_int32(data, 0x08)
@@ -257,120 +430,162 @@ class MapDataParserRoborock:
         return Point(x, y, a)
 
     @staticmethod
-    def parse_walls(data: bytes, header: bytes) -> List[Wall]:
+    def parse_walls(data: memoryview, header: memoryview) -> List[Wall]:
         wall_pairs = MapDataParserRoborock.get_int16(header, 0x08)
-        walls = []
-        for wall_start in range(0, wall_pairs * 8, 8):
-            x0 = MapDataParserRoborock.get_int16(data, wall_start + 0)
-            y0 = MapDataParserRoborock.get_int16(data, wall_start + 2)
-            x1 = MapDataParserRoborock.get_int16(data, wall_start + 4)
-            y1 = MapDataParserRoborock.get_int16(data, wall_start + 6)
-            walls.append(Wall(x0, y0, x1, y1))
-        return walls
+        return [Wall(x0, y0, x1, y1) for x0, y0, x1, y1 in _WALL.iter_unpack(data[:wall_pairs * _WALL.size])]
 
     @staticmethod
-    def parse_obstacles(data: bytes, header: bytes) -> List[Obstacle]:
+    def parse_obstacles(data: memoryview, header: memoryview) -> List[Obstacle]:
         obstacle_pairs = MapDataParserRoborock.get_int16(header, 0x08)
-        obstacles = []
         if obstacle_pairs == 0:
-            return obstacles
+            return []
         obstacle_size = int(len(data) / obstacle_pairs)
-        for obstacle_start in range(0, obstacle_pairs * obstacle_size, obstacle_size):
-            x = MapDataParserRoborock.get_int16(data, obstacle_start + 0)
-            y = MapDataParserRoborock.get_int16(data, obstacle_start + 2)
-            details = {}
-            if obstacle_size >= 6:
-                details[ATTR_TYPE] = MapDataParserRoborock.get_int16(data, obstacle_start + 4)
-                if details[ATTR_TYPE] in MapDataParserRoborock.KNOWN_OBSTACLE_TYPES:
-                    details[ATTR_DESCRIPTION] = MapDataParserRoborock.KNOWN_OBSTACLE_TYPES[details[ATTR_TYPE]]
-                if obstacle_size >= 10:
-                    u1 = MapDataParserRoborock.get_int16(data, obstacle_start + 6)
-                    u2 = MapDataParserRoborock.get_int16(data, obstacle_start + 8)
-                    details[ATTR_CONFIDENCE_LEVEL] = 0 if u2 == 0 else u1 * 10.0 / u2
-                    if obstacle_size == 28 and (data[obstacle_start + 12] & 0xFF) > 0:
-                        txt = MapDataParserRoborock.get_bytes(data, obstacle_start + 12, 16)
-                        details[ATTR_PHOTO_NAME] = txt.decode("ascii")
-            obstacles.append(Obstacle(x, y, details))
-        return obstacles
+        record = _OBSTACLE_RECORDS.get(obstacle_size)
+        if record is None:
+            # unknown sizes are read as far as the known fields go, the rest is skipped
+            known_size = max(size for size in _OBSTACLE_RECORDS if size <= min(obstacle_size, 10))
+            record = struct.Struct(f"{_OBSTACLE_RECORDS[known_size].format}{obstacle_size - known_size}x")
+        decode_details = MapDataParserRoborock.parse_obstacle_details
+        return [Obstacle(fields[0], fields[1], None, fields, decode_details)
+                for fields in record.iter_unpack(data[:obstacle_pairs * obstacle_size])]
 
     @staticmethod
-    def parse_zones(data: bytes, header: bytes) -> List[Zone]:
+    def parse_obstacle_details(fields: Tuple) -> Dict[str, Any]:
+        # fields is the whole record, starting with x and y
+        details = {}
+        if len(fields) >= 3:
+            details[ATTR_TYPE] = fields[2]
+            if details[ATTR_TYPE] in MapDataParserRoborock.KNOWN_OBSTACLE_TYPES:
+                details[ATTR_DESCRIPTION] = MapDataParserRoborock.KNOWN_OBSTACLE_TYPES[details[ATTR_TYPE]]
+            if len(fields) >= 5:
+                u1, u2 = fields[3:5]
+                details[ATTR_CONFIDENCE_LEVEL] = 0 if u2 == 0 else u1 * 10.0 / u2
+                if len(fields) == 6 and fields[5][0] > 0:
+                    details[ATTR_PHOTO_NAME] = str(fields[5], "ascii")
+        return details
+
+    @staticmethod
+    def parse_zones(data: memoryview, header: memoryview) -> List[Zone]:
         zone_pairs = MapDataParserRoborock.get_int16(header, 0x08)
-        zones = []
-        for zone_start in range(0, zone_pairs * 8, 8):
-            x0 = MapDataParserRoborock.get_int16(data, zone_start + 0)
-            y0 = MapDataParserRoborock.get_int16(data, zone_start + 2)
-            x1 = MapDataParserRoborock.get_int16(data, zone_start + 4)
-            y1 = MapDataParserRoborock.get_int16(data, zone_start + 6)
-            zones.append(Zone(x0, y0, x1, y1))
-        return zones
+        return [Zone(x0, y0, x1, y1) for x0, y0, x1, y1 in _WALL.iter_unpack(data[:zone_pairs * _WALL.size])]
 
     @staticmethod
-    def parse_path(block_start_position: int, header: bytes, raw: bytes) -> Path:
-        path_points = []
-        end_pos = MapDataParserRoborock.get_int32(header, 0x04)
-        point_length = MapDataParserRoborock.get_int32(header, 0x08)
-        point_size = MapDataParserRoborock.get_int32(header, 0x0C)
-        angle = MapDataParserRoborock.get_int32(header, 0x10)
+    def parse_path(block_start_position: int, header: memoryview, raw: memoryview) -> Path:
+        end_pos, point_length, point_size, angle = _PATH_HEADER.unpack_from(header)
         start_pos = block_start_position + 0x14
-        for pos in range(start_pos, start_pos + end_pos, 4):
-            x = MapDataParserRoborock.get_int16(raw, pos)
-            y = MapDataParserRoborock.get_int16(raw, pos + 2)
-            path_points.append(Point(x, y))
+        points = raw[start_pos:start_pos + end_pos - end_pos % _POINT.size]
+        path_points = np.frombuffer(points, dtype=_PATH_POINT).reshape(-1, 2)
         return Path(point_length, point_size, angle, [path_points])
 
     @staticmethod
-    def parse_mop_path(path: Path, mask: bytes) -> Path:
+    def parse_mop_path(path: Path, mask: memoryview) -> Path:
+        mop_mask = np.frombuffer(mask, dtype=np.uint8) != 0
         mop_paths = []
         points_num = 0
         for each_path in path.path:
-            mop_path_points = []
-            for i, point in enumerate(each_path):
-                if mask[i]:
-                    mop_path_points.append(point)
-                    if i + 1 < len(mask) and not mask[i + 1]:
-                        points_num += len(mop_path_points)
-                        mop_paths.append(mop_path_points)
-                        mop_path_points = []
-
-            points_num += len(mop_path_points)
-            mop_paths.append(mop_path_points)
+            length = min(len(each_path), len(mop_mask))
+            # the edges of the runs of 1 in the mask are where it differs from its neighbour
+            edges = np.flatnonzero(np.diff(mop_mask[:length], prepend=False, append=False))
+            starts, ends = edges[0::2].tolist(), edges[1::2].tolist()
+            mop_paths.extend(each_path[start:end] for start, end in zip(starts, ends))
+            points_num += sum(ends) - sum(starts)
+            # the last segment is kept open unless the mask goes on with a 0, then an empty one follows
+            if not ends or ends[-1] < length or (length < len(mop_mask) and not mop_mask[length]):
+                mop_paths.append(each_path[length:length])
         return Path(points_num, path.point_size, path.angle, mop_paths)
 
     @staticmethod
-    def parse_area(header: bytes, data: bytes) -> List[Area]:
+    def parse_area(header: memoryview, data: memoryview) -> List[Area]:
         area_pairs = MapDataParserRoborock.get_int16(header, 0x08)
-        areas = []
-        for area_start in range(0, area_pairs * 16, 16):
-            x0 = MapDataParserRoborock.get_int16(data, area_start + 0)
-            y0 = MapDataParserRoborock.get_int16(data, area_start + 2)
-            x1 = MapDataParserRoborock.get_int16(data, area_start + 4)
-            y1 = MapDataParserRoborock.get_int16(data, area_start + 6)
-            x2 = MapDataParserRoborock.get_int16(data, area_start + 8)
-            y2 = MapDataParserRoborock.get_int16(data, area_start + 10)
-            x3 = MapDataParserRoborock.get_int16(data, area_start + 12)
-            y3 = MapDataParserRoborock.get_int16(data, area_start + 14)
-            areas.append(Area(x0, y0, x1, y1, x2, y2, x3, y3))
-        return areas
+        return [Area(*area) for area in _AREA.iter_unpack(data[:area_pairs * _AREA.size])]
 
     @staticmethod
-    def get_bytes(data: bytes, start_index: int, size: int) -> bytes:
-        return data[start_index: start_index + size]
+    def get_int16(data: memoryview, address: int) -> int:
+        return _INT16.unpack_from(data, address)[0]
 
     @staticmethod
-    def get_int8(data: bytes, address: int) -> int:
-        return data[address] & 0xFF
+    def get_int32(data: memoryview, address: int) -> int:
+        return _INT32.unpack_from(data, address)[0]
 
-    @staticmethod
-    def get_int16(data: bytes, address: int) -> int:
-        return \
-                ((data[address + 0] << 0) & 0xFF) | \
-                ((data[address + 1] << 8) & 0xFFFF)
 
-    @staticmethod
-    def get_int32(data: bytes, address: int) -> int:
-        return \
-                ((data[address + 0] << 0) & 0xFF) | \
-                ((data[address + 1] << 8) & 0xFFFF) | \
-                ((data[address + 2] << 16) & 0xFFFFFF) | \
-                ((data[address + 3] << 24) & 0xFFFFFFFF)
+# Decodes a map payload fed in chunks, every block is added to map_data as soon as it is complete,
+# so that the robot position and the path can be read while the image is still arriving.
+# Blocks that arrive in one chunk are used in place, the others are put together in a buffer of their own size,
+# the payload is never held in one piece.
+class MapDataStreamParser:
+    def __init__(self, image_config: ImageConfig):
+        self.map_data = MapData(25500, 1000)
+        self._image_config = image_config
+        self._blocks: Dict[int, Tuple[memoryview, BlockIndex]] = {}
+        self._map_header_read = False
+        # the unit (map header or block) that is continued by the next chunk, and how much of it arrived
+        self._buffer = bytearray()
+        self._filled = 0
+
+    def _get_unit_size(self, head: Any) -> Optional[int]:
+        # the size of the map header and of every block is in their first bytes
+        if not self._map_header_read:
+            return _INT16.unpack_from(head, 2)[0] if len(head) >= 4 else None
+        if len(head) < _BLOCK_HEADER.size:
+            return None
+        _, block_header_length, block_data_length = _BLOCK_HEADER.unpack_from(head)
+        return block_header_length + block_data_length
+
+    def feed(self, chunk: bytes) -> List[int]:
+        # returns the types of the blocks completed by this chunk
+        completed = []
+        view = memoryview(chunk)
+        while len(view) > 0:
+            if self._filled == 0:
+                size = self._get_unit_size(view)
+                if size is not None and size <= len(view):
+                    completed.extend(self._add_unit(view[:size]))
+                    view = view[size:]
+                    continue
+                self._buffer = bytearray(size if size is not None else _BLOCK_HEADER.size)
+            take = min(len(view), len(self._buffer) - self._filled)
+            self._buffer[self._filled:self._filled + take] = view[:take]
+            self._filled += take
+            view = view[take:]
+            if self._filled < len(self._buffer):
+                continue
+            size = self._get_unit_size(self._buffer)
+            if size > len(self._buffer):
+                # only the start of the unit was collected so far, now that its size is known it gets its buffer
+                buffer = bytearray(size)
+                buffer[:self._filled] = self._buffer
+                self._buffer = buffer
+                continue
+            completed.extend(self._add_unit(memoryview(self._buffer)))
+            self._buffer = bytearray()
+            self._filled = 0
+        return completed
+
+    def _add_unit(self, raw: memoryview) -> List[int]:
+        map_data = self.map_data
+        if not self._map_header_read:
+            _, map_data.major_version, map_data.minor_version, map_data.map_index, \
+                map_data.map_sequence = _MAP_HEADER.unpack_from(raw)
+            self._map_header_read = True
+            return []
+        block_type, block_header_length, block_data_length = _BLOCK_HEADER.unpack_from(raw)
+        block = (0, block_header_length, block_data_length)
+        self._blocks[block_type] = (raw, block)
+        MapDataParserRoborock.add_block(map_data, block_type, raw, block, self._image_config)
+        return [block_type]
+
+    def finish(self) -> MapData:
+        # a unit cut off at the end of the payload is decoded as far as it goes
+        if self._filled > 0 or not self._map_header_read:
+            self._add_unit(memoryview(self._buffer)[:self._filled])
+            self._buffer = bytearray()
+            self._filled = 0
+        map_data = self.map_data
+        if map_data.image is not None:
+            map_data.image.base_digest = MapDataParserRoborock.get_base_digest(self._blocks)
+        if map_data.image and not map_data.image.is_empty:
+            if len(map_data.rooms) > 0 and map_data.vacuum_position is not None:
+                image_raw, image_block = self._blocks[MapDataParserRoborock.IMAGE]
+                map_data.vacuum_room = MapDataParserRoborock.get_current_vacuum_room(image_block, image_raw,
+                                                                                     map_data.vacuum_position)
+        return map_data
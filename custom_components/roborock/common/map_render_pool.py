@@ -0,0 +1,275 @@
+import io
+import logging
+import multiprocessing
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+from PIL.Image import Image as ImageType
+
+from custom_components.roborock.common.map_data import MapData
+from custom_components.roborock.common.map_data_parser import MapDataParserRoborock
+from custom_components.roborock.common.types import Colors, Drawables, EncoderConfig, ImageConfig, Sizes, Texts
+from custom_components.roborock.const import (
+    ATTRIBUTE_CALIBRATION,
+    ATTRIBUTE_CARPET_MAP,
+    ATTRIBUTE_CHARGER,
+    ATTRIBUTE_CLEANED_ROOMS,
+    ATTRIBUTE_GOTO,
+    ATTRIBUTE_GOTO_PATH,
+    ATTRIBUTE_GOTO_PREDICTED_PATH,
+    ATTRIBUTE_IGNORED_OBSTACLES,
+    ATTRIBUTE_IGNORED_OBSTACLES_WITH_PHOTO,
+    ATTRIBUTE_IMAGE,
+    ATTRIBUTE_IS_EMPTY,
+    ATTRIBUTE_MAP_NAME,
+    ATTRIBUTE_MOP_PATH,
+    ATTRIBUTE_NO_CARPET_AREAS,
+    ATTRIBUTE_NO_GO_AREAS,
+    ATTRIBUTE_NO_MOPPING_AREAS,
+    ATTRIBUTE_OBSTACLES,
+    ATTRIBUTE_OBSTACLES_WITH_PHOTO,
+    ATTRIBUTE_PATH,
+    ATTRIBUTE_ROOM_NUMBERS,
+    ATTRIBUTE_ROOMS,
+    ATTRIBUTE_VACUUM_POSITION,
+    ATTRIBUTE_VACUUM_ROOM,
+    ATTRIBUTE_VACUUM_ROOM_NAME,
+    ATTRIBUTE_WALLS,
+    ATTRIBUTE_ZONES,
+    CONF_FORMAT,
+    CONF_JPEG_QUALITY,
+    CONF_PNG_COMPRESS_LEVEL,
+    CONF_PNG_OPTIMIZE,
+    IMAGE_FORMAT_JPEG,
+    IMAGE_FORMAT_PNG,
+    IMAGE_FORMAT_WEBP,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ParsedMap(NamedTuple):
+    attributes: Dict[str, Any]
+    is_empty: bool
+    vacuum_room: Optional[int]
+    # only kept when parsed in process, a map parsed in a worker is parsed again from raw_map for rendering
+    map_data: Optional[MapData]
+    raw_map: Optional[bytes] = None
+
+
+class EncodedImage(NamedTuple):
+    data: bytes
+    encode_time: float
+    size: Tuple[int, int]
+
+
+def as_plain(value: Any) -> Any:
+    if hasattr(value, "as_dict"):
+        return as_plain(value.as_dict())
+    if isinstance(value, dict):
+        return {key: as_plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [as_plain(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return value
+
+
+def extract_attributes(map_data: MapData, attributes_to_return: List[str]) -> Dict[str, Any]:
+    attributes = {}
+    rooms = []
+    if map_data.rooms:
+        rooms = dict(
+            filter(
+                lambda x: x[0],
+                ((x[0], x[1].name) for x in map_data.rooms.items()),
+            )
+        )
+        if len(rooms) == 0:
+            rooms = list(map_data.rooms.keys())
+    # values are only evaluated for the requested attributes, so map blocks
+    # backing unused attributes are never decoded
+    for name, value in {
+        ATTRIBUTE_CALIBRATION: map_data.calibration,
+        ATTRIBUTE_CARPET_MAP: lambda: map_data.carpet_map,
+        ATTRIBUTE_CHARGER: lambda: map_data.charger,
+        ATTRIBUTE_CLEANED_ROOMS: lambda: map_data.cleaned_rooms,
+        ATTRIBUTE_GOTO: lambda: map_data.goto,
+        ATTRIBUTE_GOTO_PATH: lambda: map_data.goto_path,
+        ATTRIBUTE_GOTO_PREDICTED_PATH: lambda: map_data.predicted_path,
+        ATTRIBUTE_IGNORED_OBSTACLES: lambda: map_data.ignored_obstacles,
+        ATTRIBUTE_IGNORED_OBSTACLES_WITH_PHOTO: lambda: map_data.ignored_obstacles_with_photo,
+        ATTRIBUTE_IMAGE: lambda: map_data.image,
+        ATTRIBUTE_IS_EMPTY: lambda: map_data.image.is_empty,
+        ATTRIBUTE_MAP_NAME: lambda: map_data.map_name,
+        ATTRIBUTE_MOP_PATH: lambda: map_data.mop_path,
+        ATTRIBUTE_NO_CARPET_AREAS: lambda: map_data.no_carpet_areas,
+        ATTRIBUTE_NO_GO_AREAS: lambda: map_data.no_go_areas,
+        ATTRIBUTE_NO_MOPPING_AREAS: lambda: map_data.no_mopping_areas,
+        ATTRIBUTE_OBSTACLES: lambda: map_data.obstacles,
+        ATTRIBUTE_OBSTACLES_WITH_PHOTO: lambda: map_data.obstacles_with_photo,
+        ATTRIBUTE_PATH: lambda: map_data.path,
+        ATTRIBUTE_ROOM_NUMBERS: lambda: rooms,
+        ATTRIBUTE_ROOMS: lambda: map_data.rooms,
+        ATTRIBUTE_VACUUM_POSITION: lambda: map_data.vacuum_position,
+        ATTRIBUTE_VACUUM_ROOM: lambda: map_data.vacuum_room,
+        ATTRIBUTE_VACUUM_ROOM_NAME: lambda: map_data.vacuum_room_name,
+        ATTRIBUTE_WALLS: lambda: map_data.walls,
+        ATTRIBUTE_ZONES: lambda: map_data.zones,
+    }.items():
+        if name in attributes_to_return:
+            attributes[name] = value()
+    return attributes
+
+
+def parse_map(raw: bytes, image_config: ImageConfig, attributes: List[str], keep_map_data: bool = True) -> ParsedMap:
+    map_data = MapDataParserRoborock.parse_model(raw, image_config)
+    return ParsedMap(as_plain(extract_attributes(map_data, attributes)),
+                     map_data.image is None or map_data.image.is_empty,
+                     map_data.vacuum_room,
+                     map_data if keep_map_data else None)
+
+
+def encode_image(image: ImageType, encoder_config: EncoderConfig) -> EncodedImage:
+    start = time.perf_counter()
+    img_byte_arr = io.BytesIO()
+    image_format = encoder_config.get(CONF_FORMAT, IMAGE_FORMAT_PNG)
+    if image_format == IMAGE_FORMAT_WEBP:
+        # WebP has no palette mode, Pillow would save palette images as RGB and lose their transparency
+        if image.mode == "P" or "transparency" in image.info:
+            image = image.convert("RGBA")
+        image.save(img_byte_arr, format="WEBP", lossless=True)
+    elif image_format == IMAGE_FORMAT_JPEG:
+        # JPEG has no alpha channel, transparent pixels keep their color
+        image.convert("RGB").save(img_byte_arr, format="JPEG", quality=encoder_config.get(CONF_JPEG_QUALITY, 75))
+    else:
+        image.save(img_byte_arr, format="PNG", compress_level=encoder_config.get(CONF_PNG_COMPRESS_LEVEL, 6),
+                   optimize=encoder_config.get(CONF_PNG_OPTIMIZE, False))
+    return EncodedImage(img_byte_arr.getvalue(), time.perf_counter() - start, image.size)
+
+
+def reduce_map_image(data: bytes, factor: int, encoder_config: EncoderConfig) -> EncodedImage:
+    # thumbnails are reduced from the encoded image, so they do not depend on where the map was rendered
+    image = Image.open(io.BytesIO(data))
+    if image.mode not in ("RGB", "RGBA"):
+        # averaging creates new colors, the thumbnail of a palette image is quantized back to a palette
+        thumbnail = image.convert("RGBA").reduce(factor).quantize(256, method=Image.Quantize.FASTOCTREE)
+    else:
+        thumbnail = image.reduce(factor)
+    return encode_image(thumbnail, encoder_config)
+
+
+def render_map_image(map_data: MapData, colors: Colors, drawables: Drawables, texts: Texts, sizes: Sizes,
+                     image_config: ImageConfig, encoder_config: EncoderConfig,
+                     device_id: Optional[str] = None) -> Optional[EncodedImage]:
+    if map_data.image is None:
+        return None
+    MapDataParserRoborock.render(map_data, colors, drawables, texts, sizes, image_config, device_id)
+    return encode_image(map_data.image.data, encoder_config)
+
+
+def render_raw_map_image(raw: bytes, colors: Colors, drawables: Drawables, texts: Texts, sizes: Sizes,
+                         image_config: ImageConfig, encoder_config: EncoderConfig,
+                         device_id: Optional[str] = None) -> Optional[EncodedImage]:
+    map_data = MapDataParserRoborock.parse_model(raw, image_config)
+    return render_map_image(map_data, colors, drawables, texts, sizes, image_config, encoder_config, device_id)
+
+
+def _run_shared_map(func: Callable[..., Any], shm_name: str, size: int, *args) -> Any:
+    # copy the payload out right away so that the segment can be released
+    # without waiting for every lazily decoded block of the map
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        raw = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    return func(raw, *args)
+
+
+# Renders maps in worker processes, so that they do not compete for the GIL of Home Assistant
+class MapRenderPool:
+    def __init__(self, max_workers: int):
+        self._max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._available = True
+        # futures of broken pools complete in their management thread
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return self._available
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        with self._lock:
+            if not self._available:
+                return None
+            if self._executor is None:
+                try:
+                    self._executor = ProcessPoolExecutor(self._max_workers,
+                                                         mp_context=multiprocessing.get_context("spawn"))
+                except (ImportError, NotImplementedError, OSError) as err:
+                    self._set_unavailable(err)
+            return self._executor
+
+    def _set_unavailable(self, err: BaseException) -> None:
+        # kept until reset, the pool would fail the same way on every render
+        _LOGGER.warning("Map render process pool unavailable, rendering in process: %s", err)
+        self._available = False
+
+    def _discard(self, executor: ProcessPoolExecutor, err: BaseException) -> None:
+        # a broken pool is replaced by the next render, other jobs of the broken pool fail with it
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        _LOGGER.warning("Map render process pool broken, it is started again on the next render: %s", err)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, func: Callable[..., Any], raw: bytes, *args) -> Optional[Future]:
+        # the payload is handed over through shared memory instead of being pickled
+        executor = self._get_executor()
+        if executor is None:
+            return None
+        try:
+            shm = shared_memory.SharedMemory(create=True, size=max(len(raw), 1))
+        except OSError as err:
+            self._set_unavailable(err)
+            self.shutdown()
+            return None
+        shm.buf[:len(raw)] = raw
+        try:
+            future = executor.submit(_run_shared_map, func, shm.name, len(raw), *args)
+        except (BrokenProcessPool, RuntimeError) as err:
+            self._release(shm)
+            self._discard(executor, err)
+            return None
+        future.add_done_callback(partial(self._job_done, executor, shm))
+        return future
+
+    def _job_done(self, executor: ProcessPoolExecutor, shm: shared_memory.SharedMemory, future: Future) -> None:
+        self._release(shm)
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._discard(executor, future.exception())
+
+    @staticmethod
+    def _release(shm: shared_memory.SharedMemory) -> None:
+        shm.close()
+        shm.unlink()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def reset(self) -> None:
+        # the pool is tried again after a reload, even if it could not be started before
+        self.shutdown()
+        self._available = True
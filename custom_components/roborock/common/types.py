@@ -6,4 +6,5 @@ Drawables = List[str]
 Texts = List[Any]
 Sizes = Dict[str, float]
 ImageConfig = Dict[str, Any]
+EncoderConfig = Dict[str, Any]
 CalibrationPoints = List[Dict[str, Dict[str, Union[float, int]]]]
@@ -22,11 +22,17 @@ from .const import (
     CONF_ENTRY_CODE,
     CONF_ENTRY_PASSWORD,
     CONF_ENTRY_USERNAME,
+    CONF_FORMAT,
+    CONF_IMAGE_ENCODER,
     CONF_INCLUDE_IGNORED_OBSTACLES,
     CONF_INCLUDE_NOGO,
     CONF_INCLUDE_SHARED,
+    CONF_JPEG_QUALITY,
     CONF_LEFT,
     CONF_MAP_TRANSFORM,
+    CONF_PNG_COMPRESS_LEVEL,
+    CONF_PNG_OPTIMIZE,
+    CONF_RENDER_PROCESS_POOL,
     CONF_RIGHT,
     CONF_ROTATE,
     CONF_SCALE,
@@ -34,6 +40,9 @@ from .const import (
     CONF_TRIM,
     CONF_USER_DATA,
     DOMAIN,
+    IMAGE_FORMAT_JPEG,
+    IMAGE_FORMAT_PNG,
+    IMAGE_FORMAT_WEBP,
     VACUUM,
 )
 from .utils import get_nested_dict, set_nested_dict
@@ -275,6 +284,9 @@ ROTATION_SCHEMA = vol.All(
     discriminant=discriminant,
 )
 PERCENT_SCHEMA = vol.All(vol.Coerce(float), vol.Range(min=0, max=100))
+IMAGE_FORMAT_SCHEMA = vol.In([IMAGE_FORMAT_PNG, IMAGE_FORMAT_WEBP, IMAGE_FORMAT_JPEG])
+PNG_COMPRESS_LEVEL_SCHEMA = vol.All(vol.Coerce(int), vol.Range(min=0, max=9))
+JPEG_QUALITY_SCHEMA = vol.All(vol.Coerce(int), vol.Range(min=1, max=95))
 
 CAMERA_VALUES = {
     f"{CONF_MAP_TRANSFORM}:{CONF_SCALE}": 1.0,
@@ -285,6 +297,11 @@ CAMERA_VALUES = {
     f"{CONF_MAP_TRANSFORM}:{CONF_TRIM}:{CONF_BOTTOM}": 0.0,
     CONF_INCLUDE_IGNORED_OBSTACLES: True,
     CONF_INCLUDE_NOGO: True,
+    CONF_RENDER_PROCESS_POOL: False,
+    f"{CONF_IMAGE_ENCODER}:{CONF_FORMAT}": IMAGE_FORMAT_PNG,
+    f"{CONF_IMAGE_ENCODER}:{CONF_PNG_COMPRESS_LEVEL}": 6,
+    f"{CONF_IMAGE_ENCODER}:{CONF_PNG_OPTIMIZE}": False,
+    f"{CONF_IMAGE_ENCODER}:{CONF_JPEG_QUALITY}": 75,
 }
 
 CAMERA_SCHEMA = {
@@ -296,6 +313,11 @@ CAMERA_SCHEMA = {
     f"{CONF_MAP_TRANSFORM}:{CONF_TRIM}:{CONF_BOTTOM}": PERCENT_SCHEMA,
     CONF_INCLUDE_IGNORED_OBSTACLES: vol.Coerce(bool),
     CONF_INCLUDE_NOGO: vol.Coerce(bool),
+    CONF_RENDER_PROCESS_POOL: vol.Coerce(bool),
+    f"{CONF_IMAGE_ENCODER}:{CONF_FORMAT}": IMAGE_FORMAT_SCHEMA,
+    f"{CONF_IMAGE_ENCODER}:{CONF_PNG_COMPRESS_LEVEL}": PNG_COMPRESS_LEVEL_SCHEMA,
+    f"{CONF_IMAGE_ENCODER}:{CONF_PNG_OPTIMIZE}": vol.Coerce(bool),
+    f"{CONF_IMAGE_ENCODER}:{CONF_JPEG_QUALITY}": JPEG_QUALITY_SCHEMA,
 }
 
 VACUUM_VALUES = {CONF_INCLUDE_SHARED: True}
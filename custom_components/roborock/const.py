@@ -102,6 +102,7 @@ CONF_CLOUD_BACKUP = "cloud_backup"
 CONF_INCLUDE_SHARED = "include_shared"
 CONF_INCLUDE_NOGO = "include_nogo"
 CONF_INCLUDE_IGNORED_OBSTACLES = "include_ignored_obstacles"
+CONF_RENDER_PROCESS_POOL = "render_process_pool"
 CONF_BOTTOM = "bottom"
 CONF_COLOR = "color"
 CONF_COLORS = "colors"
@@ -110,8 +111,13 @@ CONF_DRAW = "draw"
 CONF_FORCE_API = "force_api"
 CONF_FONT = "font"
 CONF_FONT_SIZE = "font_size"
+CONF_FORMAT = "format"
+CONF_IMAGE_ENCODER = "image_encoder"
+CONF_JPEG_QUALITY = "jpeg_quality"
 CONF_LEFT = "left"
 CONF_MAP_TRANSFORM = "map_transformation"
+CONF_PNG_COMPRESS_LEVEL = "png_compress_level"
+CONF_PNG_OPTIMIZE = "png_optimize"
 CONF_RIGHT = "right"
 CONF_ROOM_COLORS = "room_colors"
 CONF_ROTATE = "rotate"
@@ -136,6 +142,16 @@ CONF_X = "x"
 CONF_Y = "y"
 CONTENT_TYPE = "image/png"
 
+IMAGE_FORMAT_JPEG = "jpeg"
+IMAGE_FORMAT_PNG = "png"
+IMAGE_FORMAT_WEBP = "webp"
+
+CONTENT_TYPES = {
+    IMAGE_FORMAT_JPEG: "image/jpeg",
+    IMAGE_FORMAT_PNG: CONTENT_TYPE,
+    IMAGE_FORMAT_WEBP: "image/webp",
+}
+
 DRAWABLE_CHARGER = "charger"
 DRAWABLE_CLEANED_AREA = "cleaned_area"
 DRAWABLE_GOTO_PATH = "goto_path"
@@ -296,6 +312,7 @@ ATTRIBUTE_IS_EMPTY = "is_empty"
 ATTRIBUTE_MAP_NAME = "map_name"
 ATTRIBUTE_MOP_PATH = "mop_path"
 ATTRIBUTE_MAP_SAVED = "map_saved"
+ATTRIBUTE_MAP_STATS = "map_stats"
 ATTRIBUTE_NO_CARPET_AREAS = "no_carpet_areas"
 ATTRIBUTE_NO_GO_AREAS = "no_go_areas"
 ATTRIBUTE_NO_MOPPING_AREAS = "no_mopping_areas"
@@ -353,6 +370,7 @@ ATTR_PHOTO_NAME = "photo_name"
 ATTR_POINT_LENGTH = "point_length"
 ATTR_POINT_SIZE = "point_size"
 ATTR_ROTATION = "rotation"
+ATTR_RUNS = "runs"
 ATTR_SCALE = "scale"
 ATTR_SIZE = "size"
 ATTR_TWO_FACTOR_AUTH = "url_2fa"